@@ -0,0 +1,250 @@
+"""
+Some benchmarks for better_exchook.
+
+Usage::
+
+    python benchmark.py  # run all benchmarks
+    python benchmark.py stack_summary  # run only bench_stack_summary
+"""
+
+from argparse import ArgumentParser
+import sys
+import time
+import traceback
+import better_exchook
+
+
+def _timeit(func, number=1):
+    """
+    :param ()->typing.Any func:
+    :param int number: how often to call it. we take the best time
+    :return: time in secs
+    :rtype: float
+    """
+    best = None
+    for _ in range(number):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def _make_stack_summary(num_frames):
+    """
+    :param int num_frames:
+    :rtype: traceback.StackSummary
+    """
+    filename = better_exchook.__file__
+    return traceback.StackSummary.from_list([(filename, 1 + i % 100, "func_%i" % i, None) for i in range(num_frames)])
+
+
+def bench_stack_summary():
+    """
+    :func:`format_tb` and :func:`iter_traceback` on a big :class:`StackSummary`,
+    like you would get e.g. from a RecursionError.
+    This should scale linearly with the number of frames.
+    """
+    for num_frames in [1000, 5000, 10000]:
+        stack = _make_stack_summary(num_frames)
+        t_iter = _timeit(lambda: list(better_exchook.iter_traceback(stack)), number=3)
+        t_format = _timeit(lambda: better_exchook.format_tb(stack, with_color=False), number=3)
+        print(
+            "%i frames: iter_traceback %.4fs, format_tb %.4fs (%.1fus/frame)"
+            % (num_frames, t_iter, t_format, t_format / num_frames * 1e6)
+        )
+
+
+class _BenchClass:
+    def method(self):
+        pass
+
+
+def bench_func_from_code_object():
+    """
+    :func:`get_func_from_code_object` with a big heap,
+    compared to the :func:`gc.get_referrers` approach which we used before.
+    """
+    import gc
+
+    co = _BenchClass.method.__code__
+    heap = [[i] for i in range(2000000)]  # many GC-tracked objects
+
+    def _resolve():
+        better_exchook._func_from_code_object_cache.clear()
+        better_exchook._func_from_code_object_index.clear()
+        better_exchook._func_from_code_object_index_modules.clear()
+        assert better_exchook.get_func_from_code_object(co) is _BenchClass.method
+
+    def _resolve_via_index():
+        better_exchook._func_from_code_object_cache.clear()
+        better_exchook._func_from_code_object_index.clear()
+        better_exchook._func_from_code_object_index_modules.clear()
+        mod = sys.modules[_BenchClass.__module__]
+        assert better_exchook._get_func_from_code_object_index(co, mod) is _BenchClass.method
+
+    def _resolve_via_gc():
+        candidates = [f for f in gc.get_referrers(co) if getattr(f, "__code__", None) is co]
+        assert candidates[0] is _BenchClass.method
+
+    print("heap with %i GC-tracked objects" % len(gc.get_objects()))
+    print("get_func_from_code_object: %.6fs" % _timeit(_resolve, number=5))
+    print("index (without co_qualname): %.6fs" % _timeit(_resolve_via_index, number=5))
+    print("gc.get_referrers: %.6fs" % _timeit(_resolve_via_gc, number=5))
+    del heap
+
+
+def bench_loaded_module_from_filename():
+    """
+    :func:`_get_loaded_module_from_filename` with many loaded modules and many filenames which never resolve
+    (like "<string>" or exec'd templates), compared to a full scan of sys.modules for every lookup.
+    """
+    import types
+
+    num_modules = 8000
+    fake_mod_names = ["_bench_fake_mod_%i" % i for i in range(num_modules)]
+    for name in fake_mod_names:
+        mod = types.ModuleType(name)
+        mod.__file__ = "/nonexisting/%s.py" % name
+        sys.modules[name] = mod
+    filenames = ["<template_%i>" % i for i in range(500)] + [sys.modules[fake_mod_names[-1]].__file__]
+
+    def _resolve():
+        for filename in filenames:
+            better_exchook._get_loaded_module_from_filename(filename)
+
+    def _resolve_via_scan():
+        for filename in filenames:
+            for mod in list(sys.modules.values()):
+                if getattr(mod, "__file__", None) == filename:
+                    break
+
+    try:
+        print("%i modules, %i filenames" % (len(sys.modules), len(filenames)))
+        print("_get_loaded_module_from_filename: %.6fs" % _timeit(_resolve, number=5))
+        print("full scan: %.6fs" % _timeit(_resolve_via_scan, number=5))
+    finally:
+        for name in fake_mod_names:
+            del sys.modules[name]
+
+
+def bench_bounded_repr():
+    """
+    :func:`bounded_repr` vs the full :func:`repr` (cut afterwards) on big containers.
+    """
+    limit = better_exchook.output_limit()
+    for name, obj in [
+        ("str of 200M chars", "x" * 200000000),
+        ("list of 1M ints", list(range(1000000))),
+        ("dict of 1M items", {i: str(i) for i in range(1000000)}),
+        ("list of 1k lists of 1k ints", [list(range(1000)) for _ in range(1000)]),
+    ]:
+        t_full = _timeit(lambda: repr(obj)[:limit], number=3)
+        t_bounded = _timeit(lambda: better_exchook.bounded_repr(obj, limit=limit), number=3)
+        print("%s: repr %.6fs, bounded_repr %.6fs" % (name, t_full, t_bounded))
+
+
+def bench_parse_py_statement():
+    """
+    Throughput of :func:`parse_py_statement`, compared to the original simple implementation.
+    """
+    from test import _parse_py_statement_reference
+
+    lines = []
+    for filename in [better_exchook.__file__, traceback.__file__]:
+        with open(filename) as f:
+            lines.extend(f.read().splitlines())
+    for name, func in [
+        ("parse_py_statement", better_exchook.parse_py_statement),
+        ("reference", _parse_py_statement_reference),
+    ]:
+        t = _timeit(lambda: [list(func(line)) for line in lines], number=3)
+        print("%s: %.0f lines/sec" % (name, len(lines) / t))
+
+
+def bench_format_exception_many_vars():
+    """
+    :func:`format_exception` where the frame references hundreds of variables,
+    i.e. lots of small output chunks are collected.
+    This should scale linearly with the number of variables.
+    """
+    import tempfile
+
+    for num_vars in [100, 500, 2000]:
+        names = ["v%i" % i for i in range(num_vars)]
+        code = "".join("%s = %i\n" % (name, i) for i, name in enumerate(names))
+        code += "raise Exception(%s)\n" % ", ".join(names)
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".py") as f:
+            f.write(code)
+            f.flush()
+            try:
+                exec(compile(code, f.name, "exec"), {})
+            except Exception:
+                exc_info = sys.exc_info()
+            t = _timeit(lambda: better_exchook.format_exception(*exc_info, clear_frames=False), number=3)
+        print("%i vars: format_exception %.4fs (%.1fus/var)" % (num_vars, t, t / num_vars * 1e6))
+
+
+def _recursive_func(n):
+    if n <= 0:
+        raise ValueError("recursion end")
+    return _recursive_func(n - 1)
+
+
+def bench_format_tb_recursion():
+    """
+    :func:`format_tb` on a deep recursion, with and without collapsing the repeated frames.
+    """
+    try:
+        _recursive_func(900)
+    except ValueError:
+        tb = sys.exc_info()[2]
+    max_cycle_len = better_exchook.cfg_collapse_repeated_frames_max_cycle_len
+    for name, cycle_len in [("collapsed", max_cycle_len), ("not collapsed", 0)]:
+        better_exchook.cfg_collapse_repeated_frames_max_cycle_len = cycle_len
+        try:
+            t = _timeit(lambda: better_exchook.format_tb(tb, with_color=False, clear_frames=False), number=3)
+            size = len("".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False)))
+        finally:
+            better_exchook.cfg_collapse_repeated_frames_max_cycle_len = max_cycle_len
+        print("%s: format_tb %.4fs, %i chars" % (name, t, size))
+
+
+def bench():
+    for k, v in sorted(globals().items()):
+        if not k.startswith("bench_"):
+            continue
+        print("running: %s()" % k)
+        v()
+
+    print("All done.")
+
+
+def main():
+    """
+    Main entry point. Either calls the given benchmark, or all of them.
+    """
+    better_exchook.install()
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("command", default=None, help="stack_summary, ...", nargs="?")
+    args = arg_parser.parse_args()
+    if args.command:
+        if "bench_%s" % args.command in globals():
+            func_name = "bench_%s" % args.command
+        elif args.command in globals():
+            func_name = args.command
+        else:
+            print("Error: Function (bench_)%s not found." % args.command)
+            sys.exit(1)
+        print("Run %s()." % func_name)
+        func = globals()[func_name]
+        func()
+        sys.exit()
+
+    # Run all benchmarks.
+    bench()
+
+
+if __name__ == "__main__":
+    main()
@@ -53,12 +53,16 @@ from __future__ import annotations
 
 import sys
 import os
+import re
+import time
 import os.path
 import threading
 import keyword
 import inspect
 import contextlib
+import collections
 import types
+import weakref
 from weakref import WeakKeyDictionary
 
 try:
@@ -103,6 +107,82 @@ cfg_print_bound_methods = False
 cfg_print_modules = False
 cfg_print_module_functions = False
 cfg_print_module_classes = False
+cfg_dedup_same_obj = True  # when the same obj is printed again, refer to the first occurrence
+cfg_collapse_repeated_frames_max_cycle_len = 10  # collapse repeated cycles of frames (e.g. recursion). 0: disable
+cfg_max_frames = None  # show only the first and last frames (half each) of longer tracebacks. None: no limit
+cfg_max_vars_per_frame = None  # None: no limit
+cfg_max_output_chars = None  # per report. when reached, show fewer vars, then no vars, then only the frame headers
+cfg_max_render_time = None  # secs per report. when reached, do not render further vars, only the frame headers
+cfg_slow_repr_threshold = None  # secs. types with a slower repr are not rendered again, see get_slow_repr_types()
+cfg_static_attribute_lookup = False  # resolve attribute chains without running properties, __getattr__, etc
+cfg_zero_retention = False  # after a report, also drop all refs to the frames, see release_exception_refs()
+cfg_max_source_statement_lines = 20  # for longer statements (e.g. big literals), only the part of the current line
+cfg_source_revalidate_interval = 1.0  # secs. 0: always check for changed source files. None: never (immutable deploy)
+cfg_deferred_queue_size = 100  # max pending reports with better_exchook(deferred=True)
+cfg_deferred_overflow = "drop"  # when the queue is full: "drop" (count and report later), "block", or "sync"
+
+
+class _LruCache:
+    """
+    Simple thread-safe bounded mapping, which evicts the least recently used entries.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param int max_size:
+        """
+        from collections import OrderedDict
+
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        :param typing.Hashable key:
+        :param T default:
+        :rtype: typing.Any|T
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        :param typing.Hashable key:
+        :param typing.Any value:
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_py_ops = ".,;:+-*/%&!=|(){}[]^<>"
+_py_spaces_re = re.compile("[ \\t\\n]*")
+_py_identifier_tail_re = re.compile("[^ \\t\\n%s#\"']*" % re.escape(_py_ops))
+_py_f_str_expr_identifier_tail_re = re.compile("[^ \\t\\n%s]*" % re.escape(_py_ops))
+_py_str_content_re = {
+    (quote, is_f_string): re.compile("[^%s\\\\%s]*" % (quote, "{}" if is_f_string else ""))
+    for quote in "\"'"
+    for is_f_string in (False, True)
+}  # plain string content, up to the next backslash, closing quote or (in an f-string) curly bracket
+_py_str_escape_chars = {"n": "\n", "t": "\t"}
 
 
 def parse_py_statement(line):
@@ -118,112 +198,86 @@ def parse_py_statement(line):
     :return: yields (type, value)
     :rtype: typing.Iterator[typing.Tuple[str,str]]
     """
-    state = 0
-    cur_token = ""
-    str_prefix = None
-    str_is_f_string = False  # whether we are in an f-string
-    str_quote = None
-    f_str_expr_opening_brackets = 0
-    spaces = " \t\n"
-    ops = ".,;:+-*/%&!=|(){}[]^<>"
-    i = 0
-
-    def _escape_char(_c):
-        if _c == "n":
-            return "\n"
-        elif _c == "t":
-            return "\t"
-        else:
-            return _c
-
-    while i < len(line):
+    i, n = 0, len(line)
+    while i < n:
         c = line[i]
+        if c in " \t\n":
+            i = _py_spaces_re.match(line, i).end()
+            continue
+        if c in _py_ops:
+            yield "op", c
+            i += 1
+            continue
+        if c == "#":
+            yield "comment", line[i + 1 :]
+            return
+        if c in "\"'":
+            str_prefix = None
+        else:  # identifier
+            end = _py_identifier_tail_re.match(line, i + 1).end()
+            if end >= n or line[end] not in "\"'":
+                yield "id", line[i:end]
+                i = end
+                continue
+            str_prefix = line[i:end]  # identifier is string prefix
+            i = end
+        # String.
+        str_quote = line[i]
+        str_type = "str" if not str_prefix else "%s-str" % str_prefix
+        str_is_f_string = bool(str_prefix) and ("f" in str_prefix or "F" in str_prefix)
+        str_content_re = _py_str_content_re[(str_quote, str_is_f_string)]
         i += 1
-        if state == 0:
-            if c in spaces:
-                pass
-            elif c in ops:
-                yield "op", c
-            elif c == "#":
-                state = 6
-            elif c in "\"'":
-                state = 1
-                str_prefix = None
-                str_is_f_string = False
-                str_quote = c
-                cur_token = ""
-            else:
-                cur_token = c
-                state = 3  # identifier
-        elif state == 1:  # string
+        cur_token = []
+        while True:
+            m = str_content_re.match(line, i)
+            cur_token.append(m.group())
+            i = m.end()
+            if i >= n:
+                return  # unterminated string
+            c = line[i]
             if c == "\\":
-                cur_token += _escape_char(line[i : i + 1])
-                i += 1
+                c = line[i + 1 : i + 2]
+                cur_token.append(_py_str_escape_chars.get(c, c))
+                i += 2
             elif c == str_quote:
-                yield "str" if not str_prefix else "%s-str" % str_prefix, cur_token
-                cur_token = ""
-                state = 0
-            elif str_is_f_string and c == "{":  # f-string
-                if line[i - 1 : i + 1] == "{{":
-                    cur_token += "{"
-                    i += 1
-                else:
-                    yield "str" if not str_prefix else "%s-str" % str_prefix, cur_token
-                    yield "f-str-expr-open", "{"
-                    cur_token = ""
-                    f_str_expr_opening_brackets = 0
-                    state = 4
-            elif str_is_f_string and c == "}" and line[i - 1 : i + 1] == "}}":
-                cur_token += "}"
+                yield str_type, "".join(cur_token)
                 i += 1
-            else:
-                cur_token += c
-        elif state == 3:  # identifier
-            if c in spaces + ops + "#":
-                yield "id", cur_token
-                cur_token = ""
-                state = 0
-                i -= 1
-            elif c in "\"'":  # identifier is string prefix
-                state = 1
-                str_prefix = cur_token
-                str_is_f_string = "f" in str_prefix or "F" in str_prefix
-                str_quote = c
-                cur_token = ""
-            else:
-                cur_token += c
-        elif state == 4:  # f-string expression (like state 0 but simplified)
-            if c in spaces:
-                pass
-            elif c in ops:
-                if f_str_expr_opening_brackets == 0 and c == "}":
-                    yield "f-str-expr-close", "}"
-                    state = 1  # back into the f-string
-                    cur_token = ""
-                else:
-                    yield "op", c
-                    if c in "([{":
-                        f_str_expr_opening_brackets += 1
-                    elif c in ")]}":
-                        if f_str_expr_opening_brackets > 0:
-                            f_str_expr_opening_brackets -= 1
-            else:
-                cur_token = c
-                state = 5  # identifier in f-string expression
-        elif state == 5:  # identifier in f-string expression (like state 3 but simplified)
-            if c in spaces + ops:
-                yield "id", cur_token
-                cur_token = ""
-                state = 4
-                i -= 1
-            else:
-                cur_token += c
-        elif state == 6:  # comment
-            cur_token += c
-    if state == 3:
-        yield "id", cur_token
-    elif state == 6:
-        yield "comment", cur_token
+                break
+            elif line[i : i + 2] in ("{{", "}}"):  # only in f-string
+                cur_token.append(c)
+                i += 2
+            elif c == "}":  # only in f-string
+                cur_token.append(c)
+                i += 1
+            else:  # "{" in f-string, i.e. f-string expression
+                yield str_type, "".join(cur_token)
+                yield "f-str-expr-open", "{"
+                cur_token = []
+                i += 1
+                f_str_expr_opening_brackets = 0
+                while True:
+                    if i >= n:
+                        return  # unterminated f-string expression
+                    c = line[i]
+                    if c in " \t\n":
+                        i = _py_spaces_re.match(line, i).end()
+                    elif c in _py_ops:
+                        i += 1
+                        if f_str_expr_opening_brackets == 0 and c == "}":
+                            yield "f-str-expr-close", "}"
+                            break  # back into the f-string
+                        yield "op", c
+                        if c in "([{":
+                            f_str_expr_opening_brackets += 1
+                        elif c in ")]}":
+                            if f_str_expr_opening_brackets > 0:
+                                f_str_expr_opening_brackets -= 1
+                    else:  # identifier in f-string expression
+                        end = _py_f_str_expr_identifier_tail_re.match(line, i + 1).end()
+                        if end >= n:
+                            return  # unterminated f-string expression
+                        yield "id", line[i:end]
+                        i = end
 
 
 def parse_py_statements(source_code):
@@ -323,6 +377,93 @@ def simple_debug_shell(globals, locals):
                     better_exchook(*sys.exc_info(), autodebugshell=False)
 
 
+class FramesNamespace:
+    """
+    Lazy ChainMap-like read-only view on the locals (or globals) of all frames of a traceback,
+    where the more recent frames take precedence.
+    Nothing is collected on construction, and :func:`materialize` only copies into a new dict when called.
+
+    This is what :func:`better_exchook` passes to :func:`debug_shell`,
+    such that we do not need to copy all locals and globals of all frames for every exception.
+    """
+
+    def __init__(self, tb, attrib, limit=None):
+        """
+        :param types.TracebackType|types.FrameType|StackSummary|None tb:
+        :param str attrib: "f_locals" or "f_globals"
+        :param int|None limit: only the first ``limit`` frames, like :func:`format_tb`
+        """
+        assert attrib in {"f_locals", "f_globals"}
+        self._tb = tb
+        self._attrib = attrib
+        self._limit = limit
+        self._maps = None  # type: typing.Optional[typing.List[typing.Dict[str, typing.Any]]]
+
+    def get_maps(self):
+        """
+        :return: the namespaces of the frames, most recent frame first
+        :rtype: list[dict[str,typing.Any]]
+        """
+        if self._maps is None:
+            maps = []
+            if self._tb is not None:
+                for f, _ in _iter_traceback_entries(self._tb):
+                    if self._limit is not None and len(maps) >= self._limit:
+                        break
+                    ns = getattr(f, self._attrib, None)
+                    if ns is not None:
+                        maps.append(ns)
+            maps.reverse()
+            self._maps = maps
+        return self._maps
+
+    def __getitem__(self, key):
+        for ns in self.get_maps():
+            if key in ns:
+                return ns[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """
+        :param str key:
+        :param typing.Any default:
+        :rtype: typing.Any
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return any(key in ns for ns in self.get_maps())
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def materialize(self):
+        """
+        :return: new dict with all the variables, like the merged (updated) dicts of all frames
+        :rtype: dict[str,typing.Any]
+        """
+        res = {}
+        for ns in reversed(self.get_maps()):
+            res.update(ns)
+        return res
+
+
+def _materialize_namespace(ns):
+    """
+    :param dict[str,typing.Any]|FramesNamespace ns:
+    :rtype: dict[str,typing.Any]
+    """
+    if isinstance(ns, FramesNamespace):
+        return ns.materialize()
+    return ns
+
+
 # keep non-PEP8 argument name for compatibility
 # noinspection PyPep8Naming
 def debug_shell(user_ns, user_global_ns, traceback=None, execWrapper=None):
@@ -330,8 +471,8 @@ def debug_shell(user_ns, user_global_ns, traceback=None, execWrapper=None):
     Spawns some interactive shell. Tries to use IPython if available.
     Falls back to :func:`pdb.post_mortem` or :func:`simple_debug_shell`.
 
-    :param dict[str,typing.Any] user_ns:
-    :param dict[str,typing.Any] user_global_ns:
+    :param dict[str,typing.Any]|FramesNamespace user_ns:
+    :param dict[str,typing.Any]|FramesNamespace user_global_ns:
     :param traceback:
     :param execWrapper:
     :return: nothing
@@ -385,6 +526,8 @@ def debug_shell(user_ns, user_global_ns, traceback=None, execWrapper=None):
                 class DummyMod:
                     """Dummy module"""
 
+                user_ns = _materialize_namespace(user_ns)
+                user_global_ns = _materialize_namespace(user_global_ns)
                 module = DummyMod()
                 module.__dict__ = user_global_ns
                 module.__name__ = "_DummyMod"
@@ -408,7 +551,7 @@ def debug_shell(user_ns, user_global_ns, traceback=None, execWrapper=None):
 
                 pdb.post_mortem(traceback)
             else:
-                simple_debug_shell(user_global_ns, user_ns)
+                simple_debug_shell(_materialize_namespace(user_global_ns), _materialize_namespace(user_ns))
 
     finally:
         # Restore original sys.excepthook. IPython might have replaced it, and we don't want that.
@@ -423,18 +566,150 @@ def output_limit():
     return 300
 
 
+class _BoundedReprLimitReached(Exception):
+    pass
+
+
+class _BoundedRepr:
+    """
+    See :func:`bounded_repr`.
+    """
+
+    def __init__(self, limit):
+        """
+        :param int limit: num chars
+        """
+        self.limit = limit
+        self.parts = []  # type: typing.List[str]
+        self.size = 0
+        self.visiting = set()  # type: typing.Set[int]  # ids of containers, to detect recursion
+
+    def write(self, s):
+        """
+        :param str s:
+        """
+        self.parts.append(s)
+        self.size += len(s)
+        if self.size > self.limit:
+            raise _BoundedReprLimitReached()
+
+    def write_repr(self, obj):
+        """
+        :param typing.Any obj:
+        """
+        t = type(obj)
+        if t in (str, bytes):
+            budget = self.limit - self.size
+            if len(obj) > budget:  # this will exceed the limit
+                self.write(repr(obj[: budget + 1])[: budget + 1])
+            else:
+                self.write(repr(obj))
+        elif t is bytearray:
+            self.write("bytearray(")
+            self.write_repr(bytes(obj[: self.limit - self.size + 1]))
+            self.write(")")
+        elif t in (list, tuple, dict, set, frozenset):
+            if not obj:
+                self.write(repr(obj))
+                return
+            if id(obj) in self.visiting:
+                self.write({list: "[...]", tuple: "(...)", dict: "{...}"}.get(t, "%s(...)" % t.__name__))
+                return
+            self.visiting.add(id(obj))
+            if t is list:
+                self.write("[")
+                self._write_items(obj)
+                self.write("]")
+            elif t is tuple:
+                self.write("(")
+                self._write_items(obj)
+                self.write(",)" if len(obj) == 1 else ")")
+            elif t is dict:
+                self.write("{")
+                for i, (key, value) in enumerate(obj.items()):
+                    if i > 0:
+                        self.write(", ")
+                    self.write_repr(key)
+                    self.write(": ")
+                    self.write_repr(value)
+                self.write("}")
+            else:
+                self.write("{" if t is set else "frozenset({")
+                self._write_items(obj)
+                self.write("}" if t is set else "})")
+            self.visiting.remove(id(obj))
+        else:
+            self.write(_repr_timed(obj))
+
+    def _write_items(self, obj):
+        """
+        :param typing.Iterable[typing.Any] obj:
+        """
+        for i, item in enumerate(obj):
+            if i > 0:
+                self.write(", ")
+            self.write_repr(item)
+
+
+def bounded_repr(obj, limit=None):
+    """
+    Like :func:`repr`, but stops producing output once it is longer than ``limit``.
+    This is done for the builtin containers, str and bytes (recursively).
+    For all other types, it falls back to :func:`repr`
+    (unless the repr of the type was slow before, see ``cfg_slow_repr_threshold``).
+
+    :param typing.Any obj:
+    :param int|None limit: num chars. :func:`output_limit` by default
+    :return: repr(obj) if it is not longer than ``limit``, otherwise some prefix of it, longer than ``limit``
+    :rtype: str
+    """
+    if limit is None:
+        limit = output_limit()
+    writer = _BoundedRepr(limit=limit)
+    try:
+        writer.write_repr(obj)
+    except _BoundedReprLimitReached:
+        pass
+    return "".join(writer.parts)
+
+
+# filename -> (_loaded_module_from_filename_index_version, alt filename or None)
+_fallback_findfile_cache = _LruCache(max_size=1000)
+
+
 def fallback_findfile(filename):
     """
     :param str filename:
-    :return: try to find the full filename, e.g. in modules, etc
+    :return: try to find the full filename, e.g. in modules, etc.
+        This is cached. If not found, we only check again when sys.modules changed.
+    :rtype: str|None
+    """
+    version = _update_loaded_module_from_filename_index()
+    cached = _fallback_findfile_cache.get(filename)
+    if cached is not None and (cached[1] is not None or cached[0] == version):
+        return cached[1]
+    alt_fn = _fallback_findfile(filename)
+    _fallback_findfile_cache.put(filename, (version, alt_fn))
+    return alt_fn
+
+
+def _fallback_findfile(filename):
+    """
+    :param str filename:
+    :return: like :func:`fallback_findfile`, but uncached
     :rtype: str|None
     """
-    mods = [m for m in list(sys.modules.values()) if m and getattr(m, "__file__", None) and filename in m.__file__]
-    if len(mods) == 0:
+    if filename.endswith(".pyc") or filename.endswith(".pyo"):
+        filename = filename[:-1]
+    _update_loaded_module_from_filename_index()
+    alt_fn = None
+    for fn in _loaded_module_files_by_basename.get(os.path.basename(filename), ()):
+        if fn.endswith(filename) and fn in _loaded_module_from_filename_cache:
+            if _loaded_module_from_filename_cache[fn] in sys.modules:  # still loaded
+                alt_fn = fn
+                break
+    if alt_fn is None:
         return None
-    alt_fn = mods[0].__file__
-    if alt_fn[-4:-1] == ".py":
-        alt_fn = alt_fn[:-1]  # *.pyc or whatever
     if not os.path.exists(alt_fn) and alt_fn.startswith("./"):
         # Maybe current dir changed.
         alt_fn2 = _cur_pwd + alt_fn[1:]
@@ -501,28 +776,150 @@ def is_source_code_missing_open_brackets(source_code):
     return is_source_code_missing_brackets(source_code, prioritize_missing_open=True) < 0
 
 
+_source_checkcache_times = _LruCache(max_size=10000)  # filename -> time of last linecache.checkcache
+_source_missing_times = _LruCache(max_size=10000)  # (filename, bool) -> time when we did not find the source
+_source_file_exists_cache = _LruCache(max_size=10000)  # filename -> (exists, time)
+
+
+def _is_pseudo_filename(filename):
+    """
+    :param str filename:
+    :return: whether this is sth like "<string>" or "<frozen importlib._bootstrap>", i.e. not a real file
+    :rtype: bool
+    """
+    return filename[:1] == "<" and filename[-1:] == ">"
+
+
+def _source_cache_is_valid(last_time, now):
+    """
+    :param float|None last_time: when we last checked, or None if never
+    :param float now:
+    :return: whether the cached information is still valid, via :data:`cfg_source_revalidate_interval`
+    :rtype: bool
+    """
+    if last_time is None:
+        return False
+    if cfg_source_revalidate_interval is None:
+        return True
+    return now - last_time < cfg_source_revalidate_interval
+
+
+def source_file_exists(filename):
+    """
+    Like :func:`os.path.isfile`, but cached, via :data:`cfg_source_revalidate_interval`.
+
+    :param str filename:
+    :rtype: bool
+    """
+    if _is_pseudo_filename(filename):
+        return False
+    now = time.monotonic()
+    exists, last_time = _source_file_exists_cache.get(filename, (None, None))
+    if _source_cache_is_valid(last_time, now):
+        return exists
+    exists = os.path.isfile(filename)
+    _source_file_exists_cache.put(filename, (exists, now))
+    return exists
+
+
+def get_source_lines(filename, module_globals=None):
+    """
+    Like :func:`linecache.getlines`, but we only call :func:`linecache.checkcache`
+    once per :data:`cfg_source_revalidate_interval`,
+    and we also remember when we did not find the source (e.g. "<string>"), to not look it up again.
+
+    :param str filename:
+    :param dict[str,typing.Any]|None module_globals:
+    :return: lines, including newline
+    :rtype: list[str]
+    """
+    import linecache
+
+    now = time.monotonic()
+    missing_key = (filename, bool(module_globals))  # with module_globals, the module loader might provide it
+    in_cache = filename in linecache.cache
+    if in_cache:
+        if not _source_cache_is_valid(_source_checkcache_times.get(filename), now):
+            _source_checkcache_times.put(filename, now)
+            linecache.checkcache(filename)
+    elif _is_pseudo_filename(filename) and not module_globals:
+        return []
+    elif _source_cache_is_valid(_source_missing_times.get(missing_key), now):
+        return []
+    lines = linecache.getlines(filename, module_globals)
+    if lines:
+        if not in_cache:  # just loaded
+            _source_checkcache_times.put(filename, now)
+    else:
+        _source_missing_times.put(missing_key, now)
+    return lines
+
+
+_statement_spans_cache = _LruCache(max_size=100)  # filename -> (lines, spans), see _get_statement_spans
+
+
+def _get_statement_spans(filename, lines):
+    """
+    :param str filename:
+    :param list[str] lines: via :func:`get_source_lines`. this identifies the version of the file
+    :return: for each line number (1-indexed), the (start, end) line numbers (1-indexed, inclusive)
+        of the statement (logical line) which covers it, or None if there is no such statement (e.g. comment).
+        None if the source cannot be tokenized.
+    :rtype: list[(int,int)|None]|None
+    """
+    cached = _statement_spans_cache.get(filename)
+    if cached and cached[0] is lines:
+        return cached[1]
+    import tokenize
+
+    spans = [None] * (len(lines) + 1)  # type: typing.List[typing.Optional[typing.Tuple[int,int]]]
+    start = None
+    try:
+        for tok in tokenize.generate_tokens(iter(lines).__next__):
+            if tok.type in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER):
+                continue
+            if start is None:
+                start = tok.start[0]
+            if tok.type == tokenize.NEWLINE:
+                end = min(tok.end[0], len(lines))
+                for lineno in range(start, end + 1):
+                    spans[lineno] = (start, end)
+                start = None
+    except Exception:  # e.g. tokenize.TokenError, SyntaxError
+        spans = None
+    _statement_spans_cache.put(filename, (lines, spans))
+    return spans
+
+
 def get_source_code(filename, lineno, module_globals=None):
     """
     :param str filename:
     :param int lineno:
     :param dict[str,typing.Any]|None module_globals:
-    :return: source code of that line (including newline)
+    :return: source code of that line (including newline).
+        In case of a multi-line statement, the whole statement,
+        or if it is longer than ``cfg_max_source_statement_lines``, only the bracket-enclosed part of the line.
     :rtype: str
     """
-    import linecache
-
-    linecache.checkcache(filename)
-    source_code = linecache.getline(filename, lineno, module_globals)
+    lines = get_source_lines(filename, module_globals)
+    if not 1 <= lineno <= len(lines):
+        return ""
+    spans = _get_statement_spans(filename, lines)
+    if spans and spans[lineno]:
+        start_line, end_line = spans[lineno]
+        if end_line - start_line < cfg_max_source_statement_lines:
+            return "".join(lines[start_line - 1 : end_line])  # 1-indexed
+    # Fallback, e.g. if the file has syntax errors, or for a line in a long statement (e.g. a big dict literal).
+    source_code = lines[lineno - 1]
     # In case of a multi-line statement, lineno is usually the last line.
     # We are checking for missing open brackets and add earlier code lines.
     start_line = end_line = lineno
-    lines = None
     while True:
         missing_bracket_level = is_source_code_missing_brackets(source_code)
         if missing_bracket_level == 0:
             break
-        if not lines:
-            lines = linecache.getlines(filename, module_globals)
+        if end_line - start_line + 1 >= cfg_max_source_statement_lines:
+            return lines[lineno - 1]  # the brackets do not close nearby
         if missing_bracket_level < 0:  # missing open bracket, add prev line
             start_line -= 1
             if start_line < 1:  # 1-indexed
@@ -638,6 +1035,56 @@ def to_bool(s, fallback=None):
     return fallback
 
 
+_py_highlight_identifier_re = re.compile("[^ \\t\\n%s#\"']+" % re.escape(_py_ops))
+_py_highlight_str_end_re = {
+    q: re.compile("(?:[^%s\\\\\\n]|\\\\.?)*%s?" % (q, q)) for q in "\"'"
+}  # after the opening quote, up to and including the closing quote, or up to the end of line
+
+
+def _py_syntax_highlight_spans(s):
+    """
+    :param str s: Python source code
+    :return: spans (start, end, palette index) which should be colored, sorted and non-overlapping.
+        The palette index is for :class:`Color` ``fg_colors``.
+    :rtype: list[(int,int,int)]
+    """
+    spans = []  # type: typing.List[typing.Tuple[int,int,int]]
+
+    def _add(start_, end_, palette_idx_):
+        if spans and spans[-1][1] == start_ and spans[-1][2] == palette_idx_:
+            spans[-1] = (spans[-1][0], end_, palette_idx_)  # merge with previous
+        else:
+            spans.append((start_, end_, palette_idx_))
+
+    i, n = 0, len(s)
+    while i < n:
+        c = s[i]
+        if c in " \t\n":
+            i += 1
+        elif c in _py_ops:
+            _add(i, i + 1, 0)
+            i += 1
+        elif c == "#":  # comment
+            end = s.find("\n", i)
+            if end < 0:
+                end = n
+            _add(i, end, 3)
+            i = end
+        elif c in "\"'":  # string
+            end = _py_highlight_str_end_re[c].match(s, i + 1).end()
+            _add(i, end, 2)
+            i = end
+        else:  # identifier
+            end = _py_highlight_identifier_re.match(s, i).end()
+            if s[i:end] in py_keywords:
+                _add(i, end, 0)
+            i = end
+    return spans
+
+
+_py_syntax_highlight_cache = _LruCache(max_size=1000)  # (filename, lineno, palette) -> (source, highlighted)
+
+
 class Color:
     """
     Helper functions provided to perform terminal coloring.
@@ -733,83 +1180,35 @@ class Color:
         """
         if not self.enable:
             return s
-        state = 0
-        spaces = " \t\n"
-        ops = ".,;:+-*/%&!=|(){}[]^<>"
-        i = 0
-        cur_token = ""
-        # pos in s -> color kwargs
-        color_args = {0: {}, len(s): {}}  # type: typing.Dict[int,typing.Dict[str,typing.Any]]
-
-        def finish_identifier():
-            """
-            Reset color to standard for current identifier.
-            """
-            if cur_token in py_keywords:
-                color_args[max([k for k in color_args.keys() if k < i])] = {"color": self.fg_colors[0]}
-
-        while i < len(s):
-            c = s[i]
-            i += 1
-            if c == "\n":
-                if state == 3:
-                    finish_identifier()
-                color_args[i] = {}
-                state = 0
-            elif state == 0:
-                if c in spaces:
-                    pass
-                elif c in ops:
-                    color_args[i - 1] = {"color": self.fg_colors[0]}
-                    color_args[i] = {}
-                elif c == "#":
-                    color_args[i - 1] = {"color": self.fg_colors[3]}
-                    state = 6
-                elif c == '"':
-                    color_args[i - 1] = {"color": self.fg_colors[2]}
-                    state = 1
-                elif c == "'":
-                    color_args[i - 1] = {"color": self.fg_colors[2]}
-                    state = 2
-                else:
-                    cur_token = c
-                    color_args[i - 1] = {}
-                    state = 3
-            elif state == 1:  # string via "
-                if c == "\\":
-                    state = 4
-                elif c == '"':
-                    color_args[i] = {}
-                    state = 0
-            elif state == 2:  # string via '
-                if c == "\\":
-                    state = 5
-                elif c == "'":
-                    color_args[i] = {}
-                    state = 0
-            elif state == 3:  # identifier
-                if c in spaces + ops + "#\"'":
-                    finish_identifier()
-                    color_args[i] = {}
-                    state = 0
-                    i -= 1
-                else:
-                    cur_token += c
-            elif state == 4:  # escape in "
-                state = 1
-            elif state == 5:  # escape in '
-                state = 2
-            elif state == 6:  # comment
-                pass
-        if state == 3:
-            finish_identifier()
-        out = ""
-        i = 0
-        while i < len(s):
-            j = min([k for k in color_args.keys() if k > i])
-            out += self.color(s[i:j], **color_args[i])
-            i = j
-        return out
+        out = []
+        pos = 0
+        for start, end, palette_idx in _py_syntax_highlight_spans(s):
+            if start > pos:
+                out.append(s[pos:start])
+            out.append(self.color(s[start:end], self.fg_colors[palette_idx]))
+            pos = end
+        out.append(s[pos:])
+        return "".join(out)
+
+    def py_syntax_highlight_source(self, s, filename, lineno):
+        """
+        Like :func:`py_syntax_highlight`, but cached by (filename, lineno, palette).
+        The same frames usually show up again and again, e.g. in some failure loop.
+
+        :param str s: source code of the given file and line
+        :param str filename:
+        :param int lineno:
+        :rtype: str
+        """
+        if not self.enable:
+            return s
+        key = (filename, lineno, tuple(self.fg_colors))
+        cached = _py_syntax_highlight_cache.get(key)
+        if cached and cached[0] == s:
+            return cached[1]
+        res = self.py_syntax_highlight(s)
+        _py_syntax_highlight_cache.put(key, (s, res))
+        return res
 
 
 class DomTerm:
@@ -972,7 +1371,10 @@ class _OutputLinesCollector:
         :param Color color:
         """
         self.color = color
-        self.lines = []
+        # Each line (what we merge into one entry) is a list of chunks, which we only join at the end,
+        # to avoid the quadratic cost of repeated string concatenation.
+        self._lines = []  # type: typing.List[typing.List[str]]
+        self.num_chars = 0  # total len of all lines
         self.dom_term = DomTerm() if DomTerm.is_domterm() else None
 
     def __call__(self, s1, s2=None, merge_into_prev=True, **kwargs):
@@ -989,10 +1391,58 @@ class _OutputLinesCollector:
             s1 = self.color(s1, **kwargs)
         if s2 is not None:
             s1 = add_indent_lines(s1, s2)
-        if merge_into_prev and self.lines:
-            self.lines[-1] += s1 + "\n"
+        self._add(s1 + "\n", merge_into_prev=merge_into_prev)
+
+    def _add(self, s, merge_into_prev=True):
+        """
+        :param str s:
+        :param bool merge_into_prev: if True and existing self.lines, merge into prev line.
+        """
+        if merge_into_prev and self._lines:
+            self._lines[-1].append(s)
         else:
-            self.lines.append(s1 + "\n")
+            self._lines.append([s])
+        self.num_chars += len(s)
+
+    @property
+    def lines(self):
+        """
+        :return: the collected lines (joined), e.g. one per frame
+        :rtype: list[str]
+        """
+        return ["".join(line) for line in self._lines]
+
+    def extend_lines(self, lines):
+        """
+        :param list[str] lines: e.g. from :func:`format_tb`, will not be merged
+        """
+        self._lines.extend([[line] for line in lines])
+        self.num_chars += sum([len(line) for line in lines])
+
+    def get_value(self):
+        """
+        :return: all collected lines joined together
+        :rtype: str
+        """
+        return "".join(["".join(line) for line in self._lines])
+
+    def replace_last_line_suffix(self, old, new):
+        """
+        :param str old:
+        :param str new:
+        :return: whether the last line ended with ``old``, and we replaced it by ``new``
+        :rtype: bool
+        """
+        if not self._lines:
+            return False
+        line = self._lines[-1]
+        if line and len(line[-1]) < len(old):
+            line[:] = ["".join(line)]
+        if not line or not line[-1].endswith(old):
+            return False
+        line[-1] = line[-1][: len(line[-1]) - len(old)] + new
+        self.num_chars += len(new) - len(old)
+        return True
 
     @contextlib.contextmanager
     def fold_text_ctx(self, line, merge_into_prev=True):
@@ -1007,10 +1457,12 @@ class _OutputLinesCollector:
             self.__call__(line, merge_into_prev=merge_into_prev)
             yield
             return
-        self.lines, old_lines = [], self.lines  # overwrite self.lines
+        self._lines, old_lines = [], self._lines  # overwrite self.lines
+        old_num_chars = self.num_chars
         yield  # collect output (in new self.lines)
-        self.lines, new_lines = old_lines, self.lines  # recover self.lines
-        hidden_text = "".join(new_lines)
+        hidden_text = self.get_value()
+        self._lines = old_lines  # recover self.lines
+        self.num_chars = old_num_chars
         import io
 
         output_buf = io.StringIO()
@@ -1020,66 +1472,14 @@ class _OutputLinesCollector:
             line = line[1:]
         self.dom_term.fold_text(line, hidden=hidden_text, file=output_buf, align=len(prefix))
         output_text = prefix[1:] + output_buf.getvalue()
-        if merge_into_prev and self.lines:
-            self.lines[-1] += output_text
-        else:
-            self.lines.append(output_text)
-
-    def _pp_extra_info(self, obj, depth_limit=3):
-        """
-        :param typing.Any|typing.Sized obj:
-        :param int depth_limit:
-        :rtype: str
-        """
-        # We want to exclude array types from Numpy, TensorFlow, PyTorch, etc.
-        # Getting __getitem__ or __len__ on them even could lead to unexpected results or deadlocks,
-        # depending on the context (e.g. inside a TF session run, extending the graph is unexpected).
-        if hasattr(obj, "shape"):
-            return ""
-        s = []
-        if hasattr(obj, "__len__"):
-            # noinspection PyBroadException
-            try:
-                if type(obj) in (str, unicode, list, tuple, dict) and len(obj) <= 5:
-                    pass  # don't print len in this case
-                else:
-                    s += ["len = " + str(obj.__len__())]
-            except Exception:
-                pass
-        if depth_limit > 0 and hasattr(obj, "__getitem__"):
-            # noinspection PyBroadException
-            try:
-                if type(obj) in (str, unicode):
-                    pass  # doesn't make sense to get subitems here
-                else:
-                    subobj = obj.__getitem__(0)  # noqa
-                    extra_info = self._pp_extra_info(subobj, depth_limit - 1)
-                    if extra_info != "":
-                        s += ["_[0]: {" + extra_info + "}"]
-            except Exception:
-                pass
-        return ", ".join(s)
+        self._add(output_text, merge_into_prev=merge_into_prev)
 
     def pretty_print(self, obj):
         """
         :param typing.Any obj:
         :rtype: str
         """
-        if isinstance(obj, types.FunctionType) and hasattr(obj, "__module__") and hasattr(obj, "__qualname__"):
-            s = "<function %s.%s>" % (obj.__module__, obj.__qualname__)
-        elif isinstance(obj, type) and hasattr(obj, "__module__") and hasattr(obj, "__qualname__"):
-            s = "<class %s.%s>" % (obj.__module__, obj.__qualname__)
-        else:
-            try:
-                s = repr(obj)
-            except Exception as exc:
-                t = type(obj)
-                s = "<%s.%s: repr-error %s: %s>" % (
-                    getattr(t, "__module__", "?"),
-                    getattr(t, "__qualname__", "?"),
-                    exc.__class__.__name__,
-                    str(exc),
-                )
+        s = _get_obj_repr(obj)
         limit = output_limit()
         if len(s) > limit:
             if self.dom_term:
@@ -1091,50 +1491,598 @@ class _OutputLinesCollector:
                 s += "..."
         else:
             s = self.color.py_syntax_highlight(s)
-        extra_info = self._pp_extra_info(obj)
+        extra_info = summarize_obj(obj)
         if extra_info != "":
             s += ", " + self.color.py_syntax_highlight(extra_info)
         return s
 
 
-# For compatibility, we keep non-PEP8 argument names.
-# noinspection PyPep8Naming
-def format_tb(
-    tb=None,
-    limit=None,
-    allLocals=None,
-    allGlobals=None,
-    withTitle=False,
-    with_color=None,
-    with_vars=None,
-    clear_frames=True,
-    colorize=None,
-):
+def _get_obj_repr(obj):
     """
-    Formats a traceback into a list of strings, each corresponding to one frame.
+    :param typing.Any obj:
+    :return: repr of obj, as we print it, but not yet cut to :func:`output_limit` (but bounded by it)
+    :rtype: str
+    """
+    if isinstance(obj, types.FunctionType) and hasattr(obj, "__module__") and hasattr(obj, "__qualname__"):
+        return "<function %s.%s>" % (obj.__module__, obj.__qualname__)
+    if isinstance(obj, type) and hasattr(obj, "__module__") and hasattr(obj, "__qualname__"):
+        return "<class %s.%s>" % (obj.__module__, obj.__qualname__)
+    try:
+        return bounded_repr(obj)
+    except Exception as exc:
+        t = type(obj)
+        return "<%s.%s: repr-error %s: %s>" % (
+            getattr(t, "__module__", "?"),
+            getattr(t, "__qualname__", "?"),
+            exc.__class__.__name__,
+            str(exc),
+        )
 
-    Replacement for traceback.format_tb.
 
-    :param types.TracebackType|types.FrameType|StackSummary tb: traceback. If None, will use sys._getframe
-    :param int|None limit: limit the traceback to this number of frames. by default, will look at sys.tracebacklimit
-    :param dict[str,typing.Any]|None allLocals: if set, will update it with all locals from all frames
-    :param dict[str,typing.Any]|None allGlobals: if set, will update it with all globals from all frames
-    :param bool withTitle:
-    :param bool|None with_color: output with ANSI escape codes for color
-    :param bool with_vars: will print var contents that are referenced in the source code line. by default enabled.
-    :param bool clear_frames: whether to call frame.clear() after processing it.
-        That will potentially fix some mem leaks regarding locals, so it can be important.
-        Also see https://github.com/python/cpython/issues/113939.
-        However, any further access to frame locals will not work (e.g., if you want to use a debugger afterward).
-    :param colorize: for compat with Python >=3.13, currently ignored
-    :return: list of strings, each corresponding to one frame in the traceback.
-        Each string contains the file name, line number, function name, source code line, maybe relevant variables,
-        etc., and a final newline.
-    :rtype: list[str]
+def _summarize_len(obj, depth_limit):
     """
-    if colorize is not None and with_color is None:
-        with_color = colorize
-    color = Color(enable=with_color)
+    :param typing.Sized obj:
+    :param int depth_limit:
+    :rtype: str
+    """
+    return "len = %i" % len(obj)
+
+
+def _summarize_sized(obj, depth_limit):
+    """
+    Like :func:`_summarize_len`, but for short objects, where the len is obvious from the repr, we don't print it.
+
+    :param typing.Sized obj:
+    :param int depth_limit:
+    :rtype: str
+    """
+    if len(obj) <= 5:
+        return ""  # don't print len in this case
+    return "len = %i" % len(obj)
+
+
+def _summarize_sequence(obj, depth_limit, min_len_shown=6):
+    """
+    :param typing.Sequence obj:
+    :param int depth_limit:
+    :param int min_len_shown: print the len only if it is at least this
+    :rtype: str
+    """
+    s = []
+    if len(obj) >= min_len_shown:
+        s += ["len = %i" % len(obj)]
+    if depth_limit > 0 and len(obj) > 0:
+        extra_info = summarize_obj(obj[0], depth_limit - 1)
+        if extra_info != "":
+            s += ["_[0]: {" + extra_info + "}"]
+    return ", ".join(s)
+
+
+def _summarize_sequence_with_len(obj, depth_limit):
+    """
+    :param typing.Sequence obj:
+    :param int depth_limit:
+    :rtype: str
+    """
+    return _summarize_sequence(obj, depth_limit, min_len_shown=0)
+
+
+# We only probe types where we know that __len__ and __getitem__ are cheap and without side effects.
+# Getting __getitem__ or __len__ on other types (lazy datasets, DB result proxies, memory-mapped stores,
+# arrays from Numpy, TensorFlow, PyTorch, etc.) could lead to I/O, unexpected results or deadlocks,
+# depending on the context (e.g. inside a TF session run, extending the graph is unexpected).
+# These are exact types, not subclasses, as a subclass could override __len__ or __getitem__.
+# The collections types here all use the builtin __len__ and __getitem__.
+_safe_obj_summarizers = {
+    str: _summarize_sized,
+    bytes: _summarize_len,
+    bytearray: _summarize_len,
+    list: _summarize_sequence,
+    tuple: _summarize_sequence,
+    range: _summarize_len,
+    dict: _summarize_sized,
+    set: _summarize_len,
+    frozenset: _summarize_len,
+    collections.OrderedDict: _summarize_len,
+    collections.defaultdict: _summarize_len,
+    collections.Counter: _summarize_len,
+    collections.deque: _summarize_sequence_with_len,
+}  # type: typing.Dict[type,typing.Callable[[typing.Any,int],str]]
+_obj_summarizers = {}  # type: typing.Dict[type,typing.Callable[[typing.Any,int],str]]  # see register_obj_summarizer
+_obj_summarizer_cache = WeakKeyDictionary()  # type -> summarizer or None
+
+
+def register_obj_summarizer(cls, func):
+    """
+    Registers a summarizer for the given type and its subclasses,
+    which provides the extra info which we print after the repr of an object, like the len of a container.
+    Only use cheap operations without side effects in it, as it is called while formatting a traceback.
+
+    :param type cls:
+    :param ((typing.Any,int)->str)|None func: gets (obj, depth_limit), returns the extra info, or "" for none.
+        For nested objects, like the first item of a container, you can pass depth_limit - 1 to :func:`summarize_obj`.
+        None to unregister.
+    """
+    if func is None:
+        _obj_summarizers.pop(cls, None)
+    else:
+        _obj_summarizers[cls] = func
+    _obj_summarizer_cache.clear()
+
+
+def summarize_obj(obj, depth_limit=3):
+    """
+    :param typing.Any obj:
+    :param int depth_limit: how deep to summarize nested objects
+    :return: extra info about obj, like the len, as we print it after the repr,
+        via the summarizer for its type, see :func:`register_obj_summarizer`.
+        Empty if there is no summarizer for the type.
+    :rtype: str
+    """
+    summarizer = _get_obj_summarizer(type(obj))
+    if summarizer is None:
+        return ""
+    # noinspection PyBroadException
+    try:
+        return summarizer(obj, depth_limit)
+    except Exception:
+        return ""
+
+
+def _get_obj_summarizer(obj_type):
+    """
+    :param type obj_type:
+    :return: summarizer for the type, see :func:`register_obj_summarizer`. This is cached per type.
+    :rtype: ((typing.Any,int)->str)|None
+    """
+    try:
+        return _obj_summarizer_cache[obj_type]
+    except (KeyError, TypeError):
+        pass
+    summarizer = None
+    for base in type.__dict__["__mro__"].__get__(obj_type):
+        if base in _obj_summarizers:
+            summarizer = _obj_summarizers[base]
+            break
+    if summarizer is None:
+        summarizer = _safe_obj_summarizers.get(obj_type)
+    try:
+        _obj_summarizer_cache[obj_type] = summarizer
+    except TypeError:
+        pass  # type not weak-referenceable
+    return summarizer
+
+
+def _format_obj_plain(obj):
+    """
+    Like :func:`_OutputLinesCollector.pretty_print`, but without any color or DomTerm escape codes.
+
+    :param typing.Any obj:
+    :return: formatted obj, and whether the repr was truncated
+    :rtype: (str, bool)
+    """
+    s = _get_obj_repr(obj)
+    limit = output_limit()
+    truncated = len(s) > limit
+    if truncated:
+        s = s[: limit - 3] + "..."
+    extra_info = summarize_obj(obj)
+    if extra_info != "":
+        s += ", " + extra_info
+    return s, truncated
+
+
+_slow_repr_types = WeakKeyDictionary()  # type -> [count, max duration], see cfg_slow_repr_threshold
+_slow_repr_types_lock = threading.Lock()
+
+
+def _repr_timed(obj):
+    """
+    Tracks the types with a slow repr (see ``cfg_slow_repr_threshold``),
+    and does not call their repr again.
+    This is used by :func:`bounded_repr` for every object which is not a builtin container, str or bytes,
+    such that the time is charged to the type whose repr is actually slow, and not e.g. to a dict containing it.
+
+    :param typing.Any obj:
+    :return: repr(obj), or a placeholder str if the repr of this type was slow before
+    :rtype: str
+    """
+    if cfg_slow_repr_threshold is None:
+        return repr(obj)
+    obj_type = type(obj)
+    # noinspection PyBroadException
+    try:
+        is_slow = obj_type in _slow_repr_types
+    except Exception:  # e.g. not weak-referenceable
+        is_slow = False
+    if is_slow:
+        return "<%s.%s, not rendered, repr was slow before>" % (
+            getattr(obj_type, "__module__", "?"),
+            getattr(obj_type, "__qualname__", "?"),
+        )
+    start_time = time.perf_counter()
+    res = repr(obj)
+    duration = time.perf_counter() - start_time
+    if duration > cfg_slow_repr_threshold:
+        # noinspection PyBroadException
+        try:
+            with _slow_repr_types_lock:
+                stats = _slow_repr_types.setdefault(obj_type, [0, 0.0])
+                stats[0] += 1
+                stats[1] = max(stats[1], duration)
+        except Exception:  # e.g. not weak-referenceable
+            pass
+    return res
+
+
+def get_slow_repr_types():
+    """
+    :return: the types where the repr was slower than ``cfg_slow_repr_threshold``,
+        which we do not render anymore, with the number of slow reprs and the max duration in secs
+    :rtype: dict[type,(int,float)]
+    """
+    with _slow_repr_types_lock:
+        return {t: (count, duration) for t, (count, duration) in _slow_repr_types.items()}
+
+
+def reset_slow_repr_types():
+    """
+    Forget all slow repr types, i.e. render them again.
+    """
+    with _slow_repr_types_lock:
+        _slow_repr_types.clear()
+
+
+_time_budget_exceeded_str = "<not rendered, time budget exceeded>"
+
+
+# (id(code) or filename, lineno) -> (weakref to code or None, source_code, identifiers).
+# Weak on the code, as it might be dynamically created, and it keeps its co_consts alive.
+_source_code_identifiers_cache = _LruCache(max_size=10000)
+
+
+def _get_source_code_identifier_prefixes(co, lineno, source_code):
+    """
+    :param types.CodeType|DummyFrame co:
+    :param int lineno:
+    :param str source_code: of that code location, via :func:`get_source_code`
+    :return: all identifiers in the source code, including all prefixes of attribute chains,
+        without duplicates, in order. E.g. for "a.b(c)": [("a",), ("a", "b"), ("c",)].
+        This is cached per code location.
+    :rtype: tuple[tuple[str,...]]
+    """
+    if isinstance(co, types.CodeType):
+        key, co_ref = (id(co), lineno), weakref.ref(co)
+    else:
+        key, co_ref = (co.co_filename, lineno), None
+    cached = _source_code_identifiers_cache.get(key)
+    # Check the ref, as the id might have been reused.
+    if cached and (cached[0] is None or cached[0]() is co) and cached[1] == source_code:
+        return cached[2]
+    res = []  # type: typing.List[typing.Tuple[str,...]]
+    covered = set()  # type: typing.Set[typing.Tuple[str,...]]
+    for token_str in grep_full_py_identifiers(parse_py_statement(source_code)):
+        splitted_token = tuple(token_str.split("."))
+        for i in range(1, len(splitted_token) + 1):
+            token = splitted_token[:i]
+            if token not in covered:
+                covered.add(token)
+                res.append(token)
+    res = tuple(res)
+    _source_code_identifiers_cache.put(key, (co_ref, source_code, res))
+    return res
+
+
+def _iter_frame_vars(f, co, lineno, source_code):
+    """
+    Resolves the identifiers of the source code of a frame, as we print them in :func:`format_tb`.
+    This respects the ``cfg_print_*`` options.
+
+    :param types.FrameType|DummyFrame f:
+    :param types.CodeType|DummyFrame co:
+    :param int lineno:
+    :param str source_code: of that code location, via :func:`get_source_code`
+    :return: yields (token, scope, obj, exc), where scope is "local", "global", "builtin", or None if not found,
+        and exc is the exception if resolving the attribute chain failed
+    :rtype: typing.Iterator[typing.Tuple[typing.Tuple[str,...],typing.Optional[str],typing.Any,typing.Optional[Exception]]]
+    """
+    for token in _get_source_code_identifier_prefixes(co, lineno, source_code):
+        if token[0] in f.f_locals:
+            token_base_dict = f.f_locals
+            scope = "local"
+        elif token[0] in f.f_globals:
+            token_base_dict = f.f_globals
+            scope = "global"
+            if (
+                not cfg_print_module_functions
+                and len(token) == 1
+                and _is_module_function(token_base_dict, token[0], obj_is_dict=True)
+            ):
+                continue
+            if (
+                not cfg_print_module_classes
+                and len(token) == 1
+                and _is_module_class(token_base_dict, token[0], obj_is_dict=True)
+            ):
+                continue
+        elif token[0] in f.f_builtins:
+            if not cfg_print_builtins:
+                continue
+            token_base_dict = f.f_builtins
+            scope = "builtin"
+        else:
+            if not cfg_print_not_found:
+                continue
+            yield token, None, None, None
+            continue
+
+        not_evaluated_parent = False
+        try:
+            token_parent_obj = None
+            token_obj = token_base_dict[token[0]]
+            for attr in token[1:]:
+                if isinstance(token_obj, NotEvaluatedAttrib):
+                    not_evaluated_parent = True
+                    break
+                token_parent_obj = token_obj
+                token_obj = _get_attrib(token_obj, attr)
+        except Exception as e:
+            yield token, scope, None, e
+            continue
+        if not_evaluated_parent:
+            continue  # the not evaluated parent is already printed
+        if (
+            not cfg_print_bound_methods
+            and token_parent_obj is not None
+            and _is_bound_method(token_parent_obj, token[-1])
+        ):
+            continue
+        if not cfg_print_modules and isinstance(token_obj, types.ModuleType):
+            continue
+        if (
+            not cfg_print_module_functions
+            and token_parent_obj is not None
+            and _is_module_function(token_parent_obj, token[-1])
+        ):
+            continue
+        if (
+            not cfg_print_module_classes
+            and token_parent_obj is not None
+            and _is_module_class(token_parent_obj, token[-1])
+        ):
+            continue
+        yield token, scope, token_obj, None
+
+
+def _get_frame_key(f, lineno):
+    """
+    :param types.FrameType|DummyFrame|FrameSnapshot f:
+    :param int lineno:
+    :return: key of the code location
+    :rtype: typing.Hashable
+    """
+    if isinstance(f, FrameSnapshot):
+        return f.filename, f.name, lineno
+    co = f.f_code
+    if isinstance(co, types.CodeType):
+        return co, lineno
+    return co.co_filename, co.co_name, lineno
+
+
+def _get_frames_skip_ranges(entries):
+    """
+    Frames which we do not show in :func:`format_tb`:
+    the middle of long tracebacks (``cfg_max_frames``),
+    and repeated cycles of frames (:func:`_get_repeated_frames_skip_ranges`).
+
+    :param list[(types.FrameType|DummyFrame|FrameSnapshot,int)] entries: (frame, lineno)
+    :return: start -> (end, message), for the frames [start, end) to skip
+    :rtype: dict[int,(int,str)]
+    """
+    res = {}
+    parts = [(0, len(entries))]
+    if cfg_max_frames is not None and len(entries) > cfg_max_frames:
+        num_head = (cfg_max_frames + 1) // 2
+        num_tail = cfg_max_frames - num_head
+        parts = [(0, num_head), (len(entries) - num_tail, len(entries))]
+        res[num_head] = (
+            len(entries) - num_tail,
+            "  [... %i frames not shown ...]" % (len(entries) - num_tail - num_head),
+        )
+    for part_start, part_end in parts:
+        ranges = _get_repeated_frames_skip_ranges(entries[part_start:part_end])
+        for start, (end, cycle_len) in ranges.items():
+            res[part_start + start] = (
+                part_start + end,
+                "  [Previous %s repeated %i more times]"
+                % ("line" if cycle_len == 1 else "%i frames" % cycle_len, (end - start) // cycle_len),
+            )
+    return res
+
+
+def _get_repeated_frames_skip_ranges(entries):
+    """
+    Finds repeated cycles of frames (by code location, see :func:`_get_frame_key`), e.g. from a recursion,
+    where we only want to show the first and the last repetition.
+    See ``cfg_collapse_repeated_frames_max_cycle_len``.
+
+    :param list[(types.FrameType|DummyFrame|FrameSnapshot,int)] entries: (frame, lineno)
+    :return: start -> (end, cycle len), for the frames [start, end) to skip
+    :rtype: dict[int,(int,int)]
+    """
+    max_cycle_len = cfg_collapse_repeated_frames_max_cycle_len
+    if not max_cycle_len:
+        return {}
+    keys = [_get_frame_key(f, lineno) for f, lineno in entries]
+    res = {}
+    i = 0
+    while i < len(keys):
+        num_repeats = 0
+        cycle_len = 1
+        while cycle_len <= max_cycle_len and i + cycle_len * 3 <= len(keys):
+            j = i + cycle_len
+            while j < len(keys) and keys[j] == keys[j - cycle_len]:
+                j += 1
+            num_repeats = (j - i) // cycle_len
+            if num_repeats >= 3:
+                break
+            cycle_len += 1
+        if num_repeats >= 3:
+            # Keep the first and the last repetition.
+            res[i + cycle_len] = (i + cycle_len * (num_repeats - 1), cycle_len)
+            i += cycle_len * num_repeats
+        else:
+            i += 1
+    return res
+
+
+def _format_var_exception(exc):
+    """
+    :param Exception exc: from resolving a variable, see :func:`_iter_frame_vars`
+    :return: how we print it instead of the repr of the variable
+    :rtype: str
+    """
+    return "!" + exc.__class__.__name__ + ": " + str(exc)
+
+
+def _get_vars_unsafe_reason():
+    """
+    :return: the reason why it might not be safe to print (repr) any vars now, or None
+    :rtype: str|None
+    """
+    if is_at_exit():
+        # Better to not show __repr__ of some vars, as this might lead to crashes
+        # when native extensions are involved.
+        return "we are exiting"
+    if any([f.f_code.co_name == "__del__" for f in iter_traceback()]):
+        # __del__ is usually called via the Python garbage collector (GC).
+        # This can happen and very random / non-deterministic places.
+        # There are cases where it is not safe to access some of the vars on the stack
+        # because they might be in a non-well-defined state, thus calling their __repr__ is not safe.
+        # See e.g. this bug:
+        # https://github.com/tensorflow/tensorflow/issues/22770
+        return "we are on a GC stack"
+    return None
+
+
+def _clear_frame(f):
+    """
+    Just like :func:`traceback.clear_frames`, but for a single frame, and with an additional fix
+    (https://github.com/python/cpython/issues/113939).
+
+    :param types.FrameType|DummyFrame f:
+    """
+    try:
+        f.clear()
+    except RuntimeError:
+        pass
+    else:
+        # Using this code triggers that the ref actually goes out of scope, otherwise it does not!
+        # https://github.com/python/cpython/issues/113939
+        f.f_locals  # noqa
+
+
+def release_exception_refs(value, tb=None):
+    """
+    Makes sure that nothing from the frames of an exception (and its chain) is kept alive by the exception:
+    clears all frames (as far as possible, i.e. not those which are still executing),
+    sets ``__traceback__`` of the exception and of all exceptions in its chain to None,
+    and resets ``sys.last_traceback`` if it belongs to this exception.
+    The exception object itself (e.g. its args) stays as it is.
+    :func:`better_exchook` calls this after the report when ``cfg_zero_retention`` is set.
+
+    :param BaseException|ExceptionSnapshot|None value:
+    :param types.TracebackType|StackSummary|None tb:
+    """
+    tbs = [tb]
+    visited = set()
+    queue = [value]
+    while queue:
+        exc = queue.pop()
+        if not isinstance(exc, BaseException) or id(exc) in visited:
+            continue
+        visited.add(id(exc))
+        tbs.append(exc.__traceback__)
+        exc.__traceback__ = None
+        queue.extend([exc.__cause__, exc.__context__])
+        sub_excs = getattr(exc, "exceptions", None)  # ExceptionGroup
+        if isinstance(sub_excs, tuple):
+            queue.extend(sub_excs)
+    for tb_ in tbs:
+        if isinstance(tb_, StackSummary):
+            _release_stack_summary_frames(tb_)
+        elif tb_ is not None:
+            for f, _ in _iter_traceback_entries(tb_):
+                _clear_frame(f)
+    if id(getattr(sys, "last_value", None)) in visited or id(getattr(sys, "last_exc", None)) in visited:
+        sys.last_traceback = None
+
+
+def _release_stack_summary_frames(stack):
+    """
+    Clears the frames of the :class:`ExtendedFrameSummary` entries and drops the references to them.
+    Afterwards, they are formatted like a plain :class:`FrameSummary`.
+
+    :param StackSummary stack:
+    """
+    for frame_summary in stack:
+        if isinstance(frame_summary, ExtendedFrameSummary) and frame_summary.tb_frame is not None:
+            _clear_frame(frame_summary.tb_frame)
+            frame_summary.tb_frame = None
+
+
+# For compatibility, we keep non-PEP8 argument names.
+# noinspection PyPep8Naming
+def format_tb(
+    tb=None,
+    limit=None,
+    allLocals=None,
+    allGlobals=None,
+    withTitle=False,
+    with_color=None,
+    with_vars=None,
+    clear_frames=True,
+    colorize=None,
+    output_budget=None,
+    time_budget=None,
+):
+    """
+    Formats a traceback into a list of strings, each corresponding to one frame.
+
+    Replacement for traceback.format_tb.
+
+    :param types.TracebackType|types.FrameType|StackSummary|TracebackSnapshot tb: traceback.
+        If None, will use sys._getframe
+    :param int|None limit: limit the traceback to this number of frames. by default, will look at sys.tracebacklimit
+    :param dict[str,typing.Any]|None allLocals: if set, will update it with all locals from all frames
+    :param dict[str,typing.Any]|None allGlobals: if set, will update it with all globals from all frames
+    :param bool withTitle:
+    :param bool|None with_color: output with ANSI escape codes for color
+    :param bool with_vars: will print var contents that are referenced in the source code line. by default enabled.
+    :param bool clear_frames: whether to call frame.clear() after processing it.
+        That will potentially fix some mem leaks regarding locals, so it can be important.
+        Also see https://github.com/python/cpython/issues/113939.
+        However, any further access to frame locals will not work (e.g., if you want to use a debugger afterward).
+    :param colorize: for compat with Python >=3.13, currently ignored
+    :param int|None output_budget: max number of chars of the output. by default, ``cfg_max_output_chars``.
+        When we run out of it, we show fewer vars, then no vars, then only the frame headers.
+        Also see ``cfg_max_frames`` and ``cfg_max_vars_per_frame``.
+    :param float|None time_budget: in secs. by default, ``cfg_max_render_time``.
+        When it is exceeded, the remaining vars are not rendered, and only the headers of the remaining frames.
+    :return: list of strings, each corresponding to one frame in the traceback.
+        Each string contains the file name, line number, function name, source code line, maybe relevant variables,
+        etc., and a final newline.
+    :rtype: list[str]
+    """
+    if colorize is not None and with_color is None:
+        with_color = colorize
+    if output_budget is None:
+        output_budget = cfg_max_output_chars
+    if time_budget is None:
+        time_budget = cfg_max_render_time
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+    deadline_exceeded = False
+    color = Color(enable=with_color)
     output = _OutputLinesCollector(color=color)
 
     def format_filename(s):
@@ -1149,7 +2097,13 @@ def format_tb(
             + color('"', color.fg_colors[2])
         )
 
-    format_py_obj = output.pretty_print
+    def format_py_obj(obj):
+        """
+        :param typing.Any obj:
+        :rtype: str
+        """
+        return output.pretty_print(obj)
+
     if tb is None:
         # noinspection PyBroadException
         try:
@@ -1170,65 +2124,145 @@ def format_tb(
     if withTitle:
         if isframe(tb) or is_stack_summary(tb):
             output(color("Traceback (most recent call first):", color.fg_colors[0]))
+        elif isinstance(tb, TracebackSnapshot) and tb.most_recent_call_first:
+            output(color("Traceback (most recent call first):", color.fg_colors[0]))
         else:  # expect traceback-object (or compatible)
             output(color("Traceback (most recent call last):", color.fg_colors[0]))
-    if with_vars is None and is_at_exit():
-        # Better to not show __repr__ of some vars, as this might lead to crashes
-        # when native extensions are involved.
-        with_vars = False
-        if withTitle:
-            output("(Exclude vars because we are exiting.)")
-    if with_vars is None:
-        if any([f.f_code.co_name == "__del__" for f in iter_traceback()]):
-            # __del__ is usually called via the Python garbage collector (GC).
-            # This can happen and very random / non-deterministic places.
-            # There are cases where it is not safe to access some of the vars on the stack
-            # because they might be in a non-well-defined state, thus calling their __repr__ is not safe.
-            # See e.g. this bug:
-            # https://github.com/tensorflow/tensorflow/issues/22770
+    if with_vars is None and not isinstance(tb, TracebackSnapshot):
+        reason = _get_vars_unsafe_reason()
+        if reason:
             with_vars = False
             if withTitle:
-                output("(Exclude vars because we are on a GC stack.)")
+                output("(Exclude vars because %s.)" % reason)
     if with_vars is None:
         with_vars = True
     locals_start_str = color("    locals:", color.fg_colors[0])
+    # id(obj) -> (obj, rendered, token, frame idx, frame location). to not render the same object again
+    rendered_objs = {}
+
+    def format_py_obj_memo(obj, token, frame_idx):
+        """
+        :param typing.Any obj:
+        :param tuple[str] token: e.g. ("self", "x")
+        :param int frame_idx: as in the output, starting with 1
+        :return: like format_py_obj, but when we already printed the same obj (by identity)
+            in this traceback, either the same output again (if it is short), or a reference to it.
+            Also returns whether this should be remembered via :func:`remember_printed_obj` once it is printed.
+        :rtype: (str, bool)
+        """
+        if not cfg_dedup_same_obj:
+            return format_py_obj(obj), False
+        memo = rendered_objs.get(id(obj))
+        if memo is None or memo[0] is not obj:
+            return format_py_obj(obj), True
+        _, rendered, token_, frame_idx_, frame_location_ = memo
+        ref_str = "<same as %s%s>" % (".".join(token_), " in %s" % frame_location_ if frame_idx_ != frame_idx else "")
+        if str_visible_len(rendered) <= len(ref_str):
+            return rendered, False
+        return color(ref_str, color.fg_colors[0]), False
+
+    def remember_printed_obj(obj, rendered, token, frame_idx, frame_location):
+        """
+        :param typing.Any obj:
+        :param str rendered: via :func:`format_py_obj_memo`
+        :param tuple[str] token:
+        :param int frame_idx: as in the output, starting with 1
+        :param str frame_location: e.g. "f, line 12", to refer to the frame
+        """
+        rendered_objs[id(obj)] = (obj, rendered, token, frame_idx, frame_location)
+
+    def iter_frame_vars(f, co, lineno, source_code):
+        """
+        :param types.FrameType|DummyFrame|FrameSnapshot f:
+        :param types.CodeType|DummyFrame|None co:
+        :param int lineno:
+        :param str source_code:
+        :return: yields (token, scope, obj, repr), like :func:`_iter_frame_vars`.
+            repr is None if obj still needs to be rendered,
+            otherwise it is already rendered (e.g. from the snapshot, or the exception while resolving it).
+            It is up to the caller to render obj, such that we only render what we actually print.
+        :rtype: typing.Iterator[typing.Tuple[typing.Tuple[str,...],typing.Optional[str],typing.Any,typing.Optional[str]]]
+        """
+        if isinstance(f, FrameSnapshot):
+            for token, scope, token_repr, _ in f.variables:
+                yield token, scope, None, token_repr
+            return
+        for token, scope, obj, exc in _iter_frame_vars(f, co, lineno, source_code):
+            if exc is not None:
+                yield token, scope, None, _format_var_exception(exc)
+            else:
+                yield token, scope, obj, None
+
+    def update_all_vars(f):
+        """
+        :param types.FrameType|DummyFrame|FrameSnapshot f:
+        """
+        if isinstance(f, FrameSnapshot):
+            return
+        if allLocals is not None:
+            allLocals.update(f.f_locals)
+        if allGlobals is not None:
+            allGlobals.update(f.f_globals)
 
     # noinspection PyBroadException
     try:
         if limit is None:
             if hasattr(sys, "tracebacklimit"):
                 limit = sys.tracebacklimit
+        entries = []
+        for entry in _iter_traceback_entries(tb):
+            if limit is not None and len(entries) >= limit:
+                break
+            entries.append(entry)
+        skip_ranges = _get_frames_skip_ranges(entries)
+        num_visible_frames = len(entries) - sum([end - start for start, (end, _) in skip_ranges.items()])
         n = 0
-        _tb = tb
-
-        while _tb is not None and (limit is None or n < limit):
-            if isframe(_tb):
-                f = _tb
-            elif is_stack_summary(_tb):
-                _tb0 = _tb[0]
-                if isinstance(_tb0, ExtendedFrameSummary):
-                    f = _tb0.tb_frame
-                else:
-                    f = DummyFrame.from_frame_summary(_tb0)
-            else:
-                f = _tb.tb_frame
-            if allLocals is not None:
-                allLocals.update(f.f_locals)
-            if allGlobals is not None:
-                allGlobals.update(f.f_globals)
-            if hasattr(_tb, "tb_lineno"):
-                lineno = _tb.tb_lineno
-            elif is_stack_summary(_tb):
-                lineno = _tb[0].lineno
+        frame_idx = 0  # as in the output (only the visible frames), starting with 1
+
+        while n < len(entries):
+            if n in skip_ranges:
+                skip_end, skip_msg = skip_ranges[n]
+                output(color(skip_msg, color.fg_colors[0]))
+                for f, _ in entries[n:skip_end]:
+                    update_all_vars(f)  # also for the frames we do not show
+                    if clear_frames and not isinstance(f, FrameSnapshot):
+                        _clear_frame(f)
+                n = skip_end
+                continue
+            if output_budget is not None and output.num_chars >= output_budget:
+                output(
+                    color(
+                        "  [... output budget exceeded, %i more frames not shown ...]" % num_visible_frames,
+                        color.fg_colors[0],
+                    )
+                )
+                for f, _ in entries[n:]:
+                    update_all_vars(f)  # also for the frames we do not show
+                    if clear_frames and not isinstance(f, FrameSnapshot):
+                        _clear_frame(f)
+                break
+            # The budget is shared equally by the remaining frames. What a frame does not use, the others get.
+            frame_budget_end = None
+            if output_budget is not None:
+                frame_budget_end = output.num_chars + (output_budget - output.num_chars) // num_visible_frames
+            num_visible_frames -= 1
+            frame_idx += 1
+            f, lineno = entries[n]
+            update_all_vars(f)
+            if isinstance(f, FrameSnapshot):
+                co = None
+                filename, name, source_code = f.filename, f.name, f.source_code
             else:
-                lineno = f.f_lineno
-            co = f.f_code
-            filename = co.co_filename
-            if not os.path.isfile(filename):
-                alt_fn = fallback_findfile(filename)
-                if alt_fn:
-                    filename = alt_fn
-            name = get_func_str_from_code_object(co, frame=f)
+                co = f.f_code
+                filename = co.co_filename
+                if not source_file_exists(filename):
+                    alt_fn = fallback_findfile(filename)
+                    if alt_fn:
+                        filename = alt_fn
+                name = get_func_str_from_code_object(co, frame=f)
+                source_code = get_source_code(filename, lineno, f.f_globals)
+                if source_code:
+                    source_code = remove_indent_lines(replace_tab_indents(source_code)).rstrip()
             file_descr = "".join(
                 [
                     "  ",
@@ -1242,126 +2276,81 @@ def format_tb(
                     name,
                 ]
             )
+            if deadline is not None and not deadline_exceeded and time.monotonic() > deadline:
+                deadline_exceeded = True
+            only_header = deadline_exceeded
+            if source_code and frame_budget_end is not None:
+                if output.num_chars + len(file_descr) + len(source_code) + 20 > frame_budget_end:
+                    only_header = True
             with output.fold_text_ctx(file_descr, merge_into_prev=False):
-                source_code = get_source_code(filename, lineno, f.f_globals)
-                if source_code:
-                    source_code = remove_indent_lines(replace_tab_indents(source_code)).rstrip()
-                    output("    line: ", color.py_syntax_highlight(source_code), color=color.fg_colors[0])
+                if only_header:
+                    pass
+                elif source_code:
+                    output(
+                        "    line: ",
+                        color.py_syntax_highlight_source(source_code, filename=filename, lineno=lineno),
+                        color=color.fg_colors[0],
+                    )
                     if not with_vars:
                         pass
                     elif isinstance(f, DummyFrame) and not f.have_vars_available:
                         pass
+                    elif isinstance(f, FrameSnapshot) and f.variables is None:
+                        pass
                     else:
                         with output.fold_text_ctx(locals_start_str):
-                            already_covered_locals = set()  # type: typing.Set[typing.Tuple[str,...]]
                             num_printed_locals = 0
-                            for token_str in grep_full_py_identifiers(parse_py_statement(source_code)):
-                                splitted_token = tuple(token_str.split("."))
-                                for token in [splitted_token[0:i] for i in range(1, len(splitted_token) + 1)]:
-                                    if token in already_covered_locals:
-                                        continue
-                                    already_covered_locals.add(token)
-                                    if token[0] in f.f_locals:
-                                        token_base_dict = f.f_locals
-                                        token_prefix_str = color("<local> ", color.fg_colors[0])
-                                    elif token[0] in f.f_globals:
-                                        token_base_dict = f.f_globals
-                                        token_prefix_str = color("<global> ", color.fg_colors[0])
-                                        if (
-                                            not cfg_print_module_functions
-                                            and len(token) == 1
-                                            and _is_module_function(token_base_dict, token[0], obj_is_dict=True)
-                                        ):
-                                            continue
-                                        if (
-                                            not cfg_print_module_classes
-                                            and len(token) == 1
-                                            and _is_module_class(token_base_dict, token[0], obj_is_dict=True)
-                                        ):
-                                            continue
-                                    elif token[0] in f.f_builtins:
-                                        if not cfg_print_builtins:
-                                            continue
-                                        token_base_dict = f.f_builtins
-                                        token_prefix_str = color("<builtin> ", color.fg_colors[0])
-                                    else:
-                                        if not cfg_print_not_found:
-                                            continue
-                                        token_base_dict = None
-                                        token_prefix_str = None
-
-                                    prefix = "      %s " % color(".", color.fg_colors[0], bold=True).join(
-                                        token
-                                    ) + color("= ", color.fg_colors[0], bold=True)
-
-                                    if token_prefix_str is None:  # not found
-                                        token_repr = color("<not found>", color.fg_colors[0])
+                            vars_omitted = False
+                            for token, scope, obj, token_repr in iter_frame_vars(f, co, lineno, source_code):
+                                # Check the limits before we render anything.
+                                if (
+                                    cfg_max_vars_per_frame is not None and num_printed_locals >= cfg_max_vars_per_frame
+                                ) or (frame_budget_end is not None and output.num_chars >= frame_budget_end):
+                                    vars_omitted = True
+                                    break
+                                remember = False
+                                if scope is not None and token_repr is None:
+                                    if deadline_exceeded or (deadline is not None and time.monotonic() > deadline):
+                                        deadline_exceeded = True
+                                        token_repr = color(_time_budget_exceeded_str, color.fg_colors[0])
                                     else:
-                                        try:
-                                            token_parent_obj = None
-                                            token_obj = token_base_dict[token[0]]
-                                            for attr in token[1:]:
-                                                token_parent_obj = token_obj
-                                                token_obj = getattr(token_obj, attr)
-                                        except Exception as e:
-                                            token_repr = token_prefix_str + "!" + e.__class__.__name__ + ": " + str(e)
-                                        else:  # found
-                                            if (
-                                                not cfg_print_bound_methods
-                                                and token_parent_obj is not None
-                                                and _is_bound_method(token_parent_obj, token[-1])
-                                            ):
-                                                continue
-                                            if not cfg_print_modules and isinstance(token_obj, types.ModuleType):
-                                                continue
-                                            if (
-                                                not cfg_print_module_functions
-                                                and token_parent_obj is not None
-                                                and _is_module_function(token_parent_obj, token[-1])
-                                            ):
-                                                continue
-                                            if (
-                                                not cfg_print_module_classes
-                                                and token_parent_obj is not None
-                                                and _is_module_class(token_parent_obj, token[-1])
-                                            ):
-                                                continue
-                                            token_repr = add_indent_lines(token_prefix_str, format_py_obj(token_obj))
-
-                                    output(prefix, token_repr)
-                                    num_printed_locals += 1
-
-                            if num_printed_locals == 0:
-                                if output.lines and output.lines[-1].endswith(locals_start_str + "\n"):
-                                    output.lines[-1] = output.lines[-1][: -len(locals_start_str) - 1]
-                                elif output.lines and output.lines[-1].endswith("\n"):
-                                    output.lines[-1] = output.lines[-1][:-1] + color(" none", color.fg_colors[0]) + "\n"
+                                        token_repr, remember = format_py_obj_memo(obj, token, frame_idx)
+                                prefix = "      %s " % color(".", color.fg_colors[0], bold=True).join(token) + color(
+                                    "= ", color.fg_colors[0], bold=True
+                                )
+                                if scope is None:  # not found
+                                    line = add_indent_lines(prefix, color("<not found>", color.fg_colors[0]))
                                 else:
+                                    line = add_indent_lines(
+                                        prefix,
+                                        add_indent_lines(color("<%s> " % scope, color.fg_colors[0]), token_repr),
+                                    )
+                                if frame_budget_end is not None and output.num_chars + len(line) >= frame_budget_end:
+                                    vars_omitted = True
+                                    break
+                                output(line)
+                                if remember:
+                                    remember_printed_obj(
+                                        obj, token_repr, token, frame_idx, "%s, line %i" % (name, lineno)
+                                    )
+                                num_printed_locals += 1
+
+                            if vars_omitted:
+                                output(color("      [... more vars not shown ...]", color.fg_colors[0]))
+                            elif num_printed_locals == 0:
+                                if output.replace_last_line_suffix(locals_start_str + "\n", ""):
+                                    pass  # just removed the "locals:" header
+                                elif not output.replace_last_line_suffix(
+                                    "\n", color(" none", color.fg_colors[0]) + "\n"
+                                ):
                                     output(color("       no locals", color.fg_colors[0]))
 
                 else:  # no source code available
                     output(color("    -- code not available --", color.fg_colors[0]))
 
-            if clear_frames:
-                # Just like :func:`traceback.clear_frames`, but has an additional fix
-                # (https://github.com/python/cpython/issues/113939).
-                try:
-                    f.clear()
-                except RuntimeError:
-                    pass
-                else:
-                    # Using this code triggers that the ref actually goes out of scope, otherwise it does not!
-                    # https://github.com/python/cpython/issues/113939
-                    f.f_locals  # noqa
-
-            if isframe(_tb):
-                _tb = _tb.f_back
-            elif is_stack_summary(_tb):
-                _tb = StackSummary.from_list(_tb[1:])
-                if not _tb:
-                    _tb = None
-            else:
-                _tb = _tb.tb_next
+            if clear_frames and not isinstance(f, FrameSnapshot):
+                _clear_frame(f)
+
             n += 1
 
     except Exception:
@@ -1371,6 +2360,8 @@ def format_tb(
         for line in traceback.format_exc().split("\n"):
             output("   " + line)
 
+    if clear_frames and cfg_zero_retention and isinstance(tb, StackSummary):
+        _release_stack_summary_frames(tb)
     return output.lines
 
 
@@ -1386,8 +2377,7 @@ def print_tb(tb, file=None, **kwargs):
     """
     if file is None:
         file = sys.stderr
-    for line in format_tb(tb=tb, **kwargs):
-        file.write(line)
+    file.write("".join(format_tb(tb=tb, **kwargs)))
     file.flush()
 
 
@@ -1417,55 +2407,73 @@ def print_exc(limit=None, file=None, chain=True):
     print_exception(*sys.exc_info(), limit=limit, file=file, chain=chain)
 
 
-def better_exchook(
+def format_exception(
     etype,
     value,
     tb,
-    debugshell=False,
-    autodebugshell=True,
-    file=None,
-    with_color=None,
-    with_preamble=True,
     limit=None,
     chain=True,
+    with_color=None,
+    with_preamble=True,
+    all_locals=None,
+    all_globals=None,
+    clear_frames=True,
+    output_budget=None,
+    time_budget=None,
 ):
     """
-    Replacement for sys.excepthook.
+    Formats the exception and its traceback with extended information.
+
+    Replacement for traceback.format_exception.
 
     :param etype: exception type
-    :param value: exception value
+    :param value: exception value, or :class:`ExceptionSnapshot` (then etype and tb are ignored)
     :param tb: traceback
-    :param bool debugshell: spawn a debug shell at the context of the exception
-    :param bool autodebugshell: if env DEBUG is an integer != 0, it will spawn a debug shell
-    :param io.TextIOBase|io.StringIO|typing.TextIO|None file: output stream where we will print the traceback
-        and exception information. stderr by default.
-    :param bool|None with_color: whether to use ANSI escape codes for colored output
-    :param bool with_preamble: print a short preamble for the exception
     :param int|None limit:
-    :param bool chain: whether to print the chain of exceptions
+    :param bool chain: whether to include the chain of exceptions
+    :param bool|None with_color: whether to use ANSI escape codes for colored output
+    :param bool with_preamble: add a short preamble for the exception
+    :param dict[str,typing.Any]|None all_locals: if set, will update it with all locals from all frames of ``tb``
+    :param dict[str,typing.Any]|None all_globals: if set, will update it with all globals from all frames of ``tb``
+    :param bool clear_frames: see :func:`format_tb`
+    :param int|None output_budget: max number of chars of the output (roughly). by default, ``cfg_max_output_chars``.
+        The chained exceptions get at most half of it. See :func:`format_tb`.
+    :param float|None time_budget: in secs, for everything, including the chained exceptions.
+        by default, ``cfg_max_render_time``. See :func:`format_tb`.
+    :return: list of strings, each ending with a newline. Concatenate them to get the full output.
+    :rtype: list[str]
     """
-    if file is None:
-        file = sys.stderr
-
-    if autodebugshell:
-        # noinspection PyBroadException
-        try:
-            debugshell = int(os.environ["DEBUG"]) != 0
-        except Exception:
-            pass
-
     color = Color(enable=with_color)
     output = _OutputLinesCollector(color=color)
-
-    rec_args = dict(autodebugshell=False, file=file, with_color=with_color, with_preamble=with_preamble)
+    is_snapshot = isinstance(value, ExceptionSnapshot)
+    if is_snapshot:
+        tb = value.tb
+    if output_budget is None:
+        output_budget = cfg_max_output_chars
+    if time_budget is None:
+        time_budget = cfg_max_render_time
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+
+    # The chained exceptions usually share some frames with us, thus we clear the frames only at the end.
+    rec_args = dict(with_color=with_color, with_preamble=with_preamble, clear_frames=False)
+    if output_budget is not None:
+        rec_args["output_budget"] = output_budget // 2
+    if time_budget is not None:
+        rec_args["time_budget"] = time_budget
     if chain:
-        if getattr(value, "__cause__", None):
-            better_exchook(type(value.__cause__), value.__cause__, value.__cause__.__traceback__, **rec_args)
+        if is_snapshot:
+            cause, context = value.cause, value.context
+        else:
+            cause, context = getattr(value, "__cause__", None), getattr(value, "__context__", None)
+        if cause:
+            output.extend_lines(format_exception(type(cause), cause, getattr(cause, "__traceback__", None), **rec_args))
             output("")
             output("The above exception was the direct cause of the following exception:")
             output("")
-        elif getattr(value, "__context__", None):
-            better_exchook(type(value.__context__), value.__context__, value.__context__.__traceback__, **rec_args)
+        elif context:
+            output.extend_lines(
+                format_exception(type(context), context, getattr(context, "__traceback__", None), **rec_args)
+            )
             output("")
             output("During handling of the above exception, another exception occurred:")
             output("")
@@ -1484,9 +2492,8 @@ def better_exchook(
 
     if with_preamble:
         output(color("EXCEPTION", color.fg_colors[1], bold=True))
-    all_locals, all_globals = {}, {}
     if tb is not None:
-        output.lines.extend(
+        output.extend_lines(
             format_tb(
                 tb=tb,
                 limit=limit,
@@ -1494,16 +2501,24 @@ def better_exchook(
                 allGlobals=all_globals,
                 withTitle=True,
                 with_color=color.enable,
-                clear_frames=not debugshell,
+                clear_frames=False,
+                output_budget=max(output_budget - output.num_chars, 0) if output_budget is not None else None,
+                time_budget=max(deadline - time.monotonic(), 0.0) if deadline is not None else None,
             )
         )
     else:
         output(color("better_exchook: traceback unknown", color.fg_colors[1]))
 
-    if isinstance(value, SyntaxError):
+    if is_snapshot:
+        syntax_error = value.syntax_error
+    elif isinstance(value, SyntaxError):
+        syntax_error = _get_syntax_error_info(value)
+    else:
+        syntax_error = None
+    if syntax_error:
         # The standard except hook will also print the source of the SyntaxError,
         # so do it in a similar way here as well.
-        filename = value.filename
+        filename, alt_filename, lineno, offset, source_code = syntax_error
         # Keep the output somewhat consistent with format_tb.
         file_descr = "".join(
             [
@@ -1512,19 +2527,15 @@ def better_exchook(
                 format_filename(filename),
                 ", ",
                 color("line ", color.fg_colors[0]),
-                color("%d" % value.lineno, color.fg_colors[4]),
+                color("%d" % lineno, color.fg_colors[4]),
             ]
         )
         with output.fold_text_ctx(file_descr):
-            if not os.path.isfile(filename):
-                alt_fn = fallback_findfile(filename)
-                if alt_fn:
-                    output(
-                        color("    -- couldn't find file, trying this instead: ", color.fg_colors[0])
-                        + format_filename(alt_fn)
-                    )
-                    filename = alt_fn
-            source_code = get_source_code(filename, value.lineno)
+            if alt_filename:
+                output(
+                    color("    -- couldn't find file, trying this instead: ", color.fg_colors[0])
+                    + format_filename(alt_filename)
+                )
             if source_code:
                 # Similar to remove_indent_lines.
                 # But we need to know the indent-prefix such that we can use the syntax-error offset.
@@ -1537,58 +2548,602 @@ def better_exchook(
                 source_code = source_code.rstrip()
                 prefix = "    line: "
                 output(prefix, color.py_syntax_highlight(source_code), color=color.fg_colors[0])
-                output(" " * (len(prefix) + value.offset - len(indent_prefix) - 1) + "^", color=color.fg_colors[4])
+                output(" " * (len(prefix) + offset - len(indent_prefix) - 1) + "^", color=color.fg_colors[4])
 
-    import types
+    if is_snapshot:
+        etype_name, value_str = value.type_name, value.value_str
+    else:
+        etype_name, value_str = _get_exc_type_name_and_str(etype, value)
+    if output_budget is not None and len(value_str) > output_limit():
+        value_str = value_str[: output_limit() - 3] + "..."
+    if value_str:
+        output(color(etype_name, color.fg_colors[1]) + ": %s" % (value_str,))
+    else:
+        output(color(etype_name, color.fg_colors[1]))
+
+    if clear_frames and not is_snapshot:
+        _clear_exception_frames(value, tb, chain=chain)
+    return output.lines
+
+
+def _clear_exception_frames(value, tb, chain=True):
+    """
+    Clears the frames of the traceback, and of the chained exceptions (like we format them).
+    This should be done only after we are done with all of them, as they usually share some frames.
+
+    :param BaseException|None value:
+    :param types.TracebackType|StackSummary|None tb:
+    :param bool chain: whether to also clear the frames of the chained exceptions
+    """
+    visited = set()
+    while True:
+        if tb is not None:
+            for f, _ in _iter_traceback_entries(tb):
+                if not isinstance(f, FrameSnapshot):
+                    _clear_frame(f)
+        if not chain or value is None or id(value) in visited:
+            break
+        visited.add(id(value))
+        value = getattr(value, "__cause__", None) or getattr(value, "__context__", None)
+        tb = getattr(value, "__traceback__", None)
+
+
+def _get_exc_type_name_and_str(etype, value):
+    """
+    :param etype: exception type
+    :param value: exception value
+    :return: type name, str of the value (empty if there is no value), as we print it
+    :rtype: (str, str)
+    """
+    # noinspection PyUnresolvedReferences
+    if (
+        isinstance(etype, BaseException)
+        or (hasattr(types, "InstanceType") and isinstance(etype, types.InstanceType))
+        or etype is None
+        or type(etype) is str
+    ):
+        etype_name = "%s" % etype
+    else:
+        etype_name = etype.__name__
+    if value is None:
+        return etype_name, ""
+    # noinspection PyBroadException
+    try:
+        value_str = str(value)
+    except Exception:
+        value_str = "<unprintable %s object>" % type(value).__name__
+    return etype_name, value_str
+
+
+def _get_syntax_error_info(value):
+    """
+    :param SyntaxError value:
+    :return: filename, alternative filename if we did not find the file, lineno, offset, source code
+    :rtype: (str, str|None, int, int|None, str|None)
+    """
+    filename = value.filename
+    alt_filename = None
+    if not source_file_exists(filename):
+        alt_filename = fallback_findfile(filename)
+    source_code = get_source_code(alt_filename or filename, value.lineno)
+    return filename, alt_filename, value.lineno, value.offset, source_code
+
+
+def format_exception_json(etype, value, tb, limit=None, chain=True, clear_frames=True):
+    """
+    Formats the exception as one JSON object in a single line (JSON lines), for log ingestion.
+    Unlike :func:`format_exception`, this does not use any color or DomTerm escape codes.
+
+    The object has the keys "type", "value" (str of the exception) and "chain",
+    which is the list of the chained exceptions (oldest first, the last one is the exception itself),
+    each with "type", "value", "link" (how it is linked to the previous one: null, "cause" or "context")
+    and "frames" (null if the traceback is unknown).
+    Each frame has "filename", "lineno", "name", "source" and "vars" (if captured),
+    and each var has "name", "scope" ("local", "global", "builtin", or null if not found), "repr" and "truncated".
+
+    :param etype: exception type
+    :param value: exception value, or :class:`ExceptionSnapshot` (then etype and tb are ignored)
+    :param tb: traceback
+    :param int|None limit:
+    :param bool chain: whether to include the chain of exceptions
+    :param bool clear_frames: see :func:`format_tb`
+    :return: JSON object, ending with a newline
+    :rtype: str
+    """
+    if not isinstance(value, ExceptionSnapshot):
+        value = ExceptionSnapshot.from_exception(etype, value, tb, limit=limit, chain=chain, clear_frames=clear_frames)
+    return _json_dumps_line(value.to_dict())
+
+
+def _json_dumps_line(obj):
+    """
+    :param dict[str,typing.Any] obj:
+    :return: JSON, ending with a newline
+    :rtype: str
+    """
+    import json
+
+    return json.dumps(obj, separators=(",", ":")) + "\n"
+
+
+def get_exception_fingerprint(etype, value, tb):
+    """
+    :param etype: exception type
+    :param value: exception value
+    :param tb: traceback
+    :return: fingerprint of the exception: the type and the sequence of code locations (code, lineno) in tb.
+        The same exception raised at the same place (via the same calls) has the same fingerprint.
+    :rtype: typing.Hashable
+    """
+    etype_name, _ = _get_exc_type_name_and_str(etype, None)
+    frames = []
+    if tb is not None:
+        for f, lineno in _iter_traceback_entries(tb):
+            co = f.f_code
+            frames.append((co.co_filename, co.co_name, lineno))
+    return etype_name, tuple(frames)
+
+
+class ExceptionRateLimiter:
+    """
+    Rate limiting of exception reports, per fingerprint (:func:`get_exception_fingerprint`),
+    for ``better_exchook(rate_limit=...)``.
+
+    Within each time window, the first ``max_full_reports`` exceptions with the same fingerprint
+    get a full report, the next ``max_summaries`` only a one-line summary with the repeat counter,
+    and all further ones are suppressed and only counted.
+    At most every ``digest_interval`` secs, the counts of the suppressed reports are written as a digest,
+    either with the next report, or by a timer (:func:`schedule_digest`), and at exit at the latest.
+    """
+
+    def __init__(self, window=60.0, max_full_reports=3, max_summaries=10, digest_interval=60.0, max_fingerprints=1000):
+        """
+        :param float window: in secs
+        :param int max_full_reports: per fingerprint and window
+        :param int max_summaries: per fingerprint and window, after the full reports
+        :param float digest_interval: in secs
+        :param int max_fingerprints: how many fingerprints we keep track of
+        """
+        self.window = window
+        self.max_full_reports = max_full_reports
+        self.max_summaries = max_summaries
+        self.digest_interval = digest_interval
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._windows = _LruCache(max_size=max_fingerprints)  # fingerprint -> [window start time, count]
+        self._suppressed = {}  # fingerprint -> [label, count], since the last digest
+        self._num_suppressed_other = 0  # when there are too many fingerprints in self._suppressed
+        self._last_digest_time = time.monotonic()
+        self._digest_file = None  # type: typing.Optional[typing.TextIO]  # see schedule_digest
+        self._digest_timer = None  # type: typing.Optional[threading.Timer]
+
+    def check(self, fingerprint, now=None):
+        """
+        Registers another exception with this fingerprint.
+
+        :param typing.Hashable fingerprint:
+        :param float|None now: time.monotonic()
+        :return: "full", "summary" or "suppress", and the count of this fingerprint in the current window
+        :rtype: (str, int)
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(fingerprint)
+            if window is None or now - window[0] >= self.window:
+                window = [now, 0]
+                self._windows.put(fingerprint, window)
+            window[1] += 1
+            count = window[1]
+        if count <= self.max_full_reports:
+            return "full", count
+        if count <= self.max_full_reports + self.max_summaries:
+            return "summary", count
+        return "suppress", count
+
+    def add_suppressed(self, fingerprint, label):
+        """
+        :param typing.Hashable fingerprint:
+        :param str label: to describe the exception in the digest
+        """
+        with self._lock:
+            entry = self._suppressed.get(fingerprint)
+            if entry is not None:
+                entry[1] += 1
+            elif len(self._suppressed) < self.max_fingerprints:
+                self._suppressed[fingerprint] = [label, 1]
+            else:
+                self._num_suppressed_other += 1
+
+    def pop_digest(self, now=None, force=False):
+        """
+        :param float|None now: time.monotonic()
+        :param bool force: even when digest_interval has not passed yet
+        :return: lines of the digest of the suppressed reports since the last digest,
+            or empty if digest_interval has not passed yet or if nothing was suppressed
+        :rtype: list[str]
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            if not self._suppressed and not self._num_suppressed_other:
+                return []
+            if not force and now - self._last_digest_time < self.digest_interval:
+                return []
+            duration = now - self._last_digest_time
+            self._last_digest_time = now
+            suppressed, self._suppressed = self._suppressed, {}
+            num_other, self._num_suppressed_other = self._num_suppressed_other, 0
+        lines = ["better_exchook: suppressed exception reports in the last %.0f secs:\n" % duration]
+        for label, count in suppressed.values():
+            lines.append("  %i x %s\n" % (count, label))
+        if num_other:
+            lines.append("  %i x other exceptions\n" % num_other)
+        return lines
+
+    def schedule_digest(self, file):
+        """
+        Makes sure that the digest of the suppressed reports is written to ``file``
+        even when no further exception comes in:
+        by a timer once ``digest_interval`` has passed, and at exit at the latest.
+
+        :param io.TextIOBase|io.StringIO|typing.TextIO file:
+        """
+        import atexit
+
+        with self._lock:
+            if self._digest_file is None:
+                atexit.register(_write_rate_limiter_digest_at_exit, weakref.ref(self))
+            self._digest_file = file
+            if self._digest_timer is not None and self._digest_timer.is_alive():
+                return
+            delay = max(self._last_digest_time + self.digest_interval - time.monotonic(), 0.0)
+            self._digest_timer = threading.Timer(delay, self.write_digest)
+            self._digest_timer.daemon = True
+            self._digest_timer.start()
+
+    def write_digest(self, force=True):
+        """
+        Writes the digest (:func:`pop_digest`) to the file from :func:`schedule_digest`, if there is anything.
+
+        :param bool force: even when digest_interval has not passed yet
+        """
+        file = self._digest_file
+        if file is None:
+            return
+        lines = self.pop_digest(force=force)
+        if lines:
+            file.write("".join(lines))
+            file.flush()
+
+
+def _write_rate_limiter_digest_at_exit(limiter_ref):
+    """
+    :param weakref.ref[ExceptionRateLimiter] limiter_ref:
+    """
+    limiter = limiter_ref()
+    if limiter is None:
+        return
+    # noinspection PyBroadException
+    try:
+        limiter.write_digest()
+    except Exception:
+        pass  # e.g. the file is already closed
+
+
+_default_exception_rate_limiter = None  # type: typing.Optional[ExceptionRateLimiter]
+_default_exception_rate_limiter_lock = threading.Lock()
+
+
+def _get_default_exception_rate_limiter():
+    """
+    :rtype: ExceptionRateLimiter
+    """
+    global _default_exception_rate_limiter
+    with _default_exception_rate_limiter_lock:
+        if _default_exception_rate_limiter is None:
+            _default_exception_rate_limiter = ExceptionRateLimiter()
+        return _default_exception_rate_limiter
+
+
+def _get_exception_label(etype, value, tb):
+    """
+    :param etype: exception type
+    :param value: exception value
+    :param tb: traceback
+    :return: one-line description of the exception, e.g. for :class:`ExceptionRateLimiter`
+    :rtype: str
+    """
+    etype_name, value_str = _get_exc_type_name_and_str(etype, value)
+    label = etype_name
+    if value_str:
+        value_str = value_str.replace("\n", " ")
+        if len(value_str) > 200:
+            value_str = value_str[:197] + "..."
+        label += ": " + value_str
+    last_entry = None
+    if tb is not None:
+        for last_entry in _iter_traceback_entries(tb):
+            pass
+    if last_entry:
+        f, lineno = last_entry
+        label += " (at %s:%i)" % (f.f_code.co_filename, lineno)
+    return label
+
+
+class _DeferredWriter:
+    """
+    Formats and writes :class:`ExceptionSnapshot` reports in a background thread,
+    for ``better_exchook(deferred=True)``.
+    """
+
+    def __init__(self):
+        import queue
+
+        self.queue = queue.Queue(maxsize=cfg_deferred_queue_size)
+        self.lock = threading.Lock()
+        self.num_dropped = 0
+        self.thread = None  # type: typing.Optional[threading.Thread]
+
+    def submit(self, file, render, fallback=None):
+        """
+        :param io.TextIOBase|io.StringIO|typing.TextIO file:
+        :param ()->str render: formats the report, e.g. an :class:`ExceptionSnapshot`
+        :param str|None fallback: written instead of the report if render fails, e.g. the exception line
+        """
+        import queue
+
+        self._ensure_thread()
+        item = (file, render, fallback)
+        try:
+            self.queue.put(item, block=cfg_deferred_overflow == "block")
+        except queue.Full:
+            if cfg_deferred_overflow == "sync":
+                self._write(file, render)
+            else:
+                with self.lock:
+                    self.num_dropped += 1
+
+    def flush(self, timeout=None):
+        """
+        Waits until all pending reports are written.
+
+        :param float|None timeout: in secs
+        :return: whether all pending reports were written
+        :rtype: bool
+        """
+        end_time = time.monotonic() + timeout if timeout is not None else None
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                if end_time is None:
+                    self.queue.all_tasks_done.wait()
+                else:
+                    remaining = end_time - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _ensure_thread(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            if self.thread is None:
+                import atexit
+
+                # Uncaught exceptions are reported right before exit, so make sure we write them.
+                atexit.register(self.flush, timeout=10.0)
+            self.thread = threading.Thread(target=self._run, name="better_exchook deferred writer", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            file, render, fallback = self.queue.get()
+            # noinspection PyBroadException
+            try:
+                self._write(file, render)
+            except Exception as exc:
+                self._write_render_failed(file, fallback, exc)
+            finally:
+                del file, render, fallback
+                self.queue.task_done()
+
+    def _write(self, file, render):
+        """
+        :param io.TextIOBase|io.StringIO|typing.TextIO file:
+        :param ()->str render:
+        """
+        s = render()
+        with self.lock:
+            num_dropped, self.num_dropped = self.num_dropped, 0
+        if num_dropped:
+            s = "better_exchook: dropped %i exception report(s), too many pending\n" % num_dropped + s
+        file.write(s)
+        file.flush()
+
+    @staticmethod
+    def _write_render_failed(file, fallback, exc):
+        """
+        :param io.TextIOBase|io.StringIO|typing.TextIO file:
+        :param str|None fallback:
+        :param Exception exc: from rendering the report
+        """
+        import traceback
+
+        s = "better_exchook: rendering the exception report failed: " + "".join(
+            traceback.format_exception_only(type(exc), exc)
+        )
+        if fallback:
+            s += fallback
+        # noinspection PyBroadException
+        try:
+            file.write(s)
+            file.flush()
+        except Exception:
+            pass  # nothing we can do about it here
+
+
+_deferred_writer = None  # type: typing.Optional[_DeferredWriter]
+_deferred_writer_lock = threading.Lock()
+
+
+def _get_deferred_writer():
+    """
+    :rtype: _DeferredWriter
+    """
+    global _deferred_writer
+    with _deferred_writer_lock:
+        if _deferred_writer is None:
+            _deferred_writer = _DeferredWriter()
+        return _deferred_writer
+
+
+def flush_deferred_reports(timeout=None):
+    """
+    Waits until all reports from ``better_exchook(deferred=True)`` are written.
+
+    :param float|None timeout: in secs
+    :return: whether all pending reports were written
+    :rtype: bool
+    """
+    if _deferred_writer is None:
+        return True
+    return _deferred_writer.flush(timeout=timeout)
+
+
+def better_exchook(
+    etype,
+    value,
+    tb,
+    debugshell=False,
+    autodebugshell=True,
+    file=None,
+    with_color=None,
+    with_preamble=True,
+    limit=None,
+    chain=True,
+    deferred=False,
+    as_json=False,
+    rate_limit=None,
+):
+    """
+    Replacement for sys.excepthook.
+
+    :param etype: exception type
+    :param value: exception value
+    :param tb: traceback
+    :param bool debugshell: spawn a debug shell at the context of the exception
+    :param bool autodebugshell: if env DEBUG is an integer != 0, it will spawn a debug shell
+    :param io.TextIOBase|io.StringIO|typing.TextIO|None file: output stream where we will print the traceback
+        and exception information. stderr by default.
+    :param bool|None with_color: whether to use ANSI escape codes for colored output
+    :param bool with_preamble: print a short preamble for the exception
+    :param int|None limit:
+    :param bool chain: whether to print the chain of exceptions
+    :param bool deferred: only capture a compact snapshot (:class:`ExceptionSnapshot`) here,
+        and release the frames right away. Formatting and writing is done in a background thread.
+        See ``cfg_deferred_queue_size``, ``cfg_deferred_overflow`` and :func:`flush_deferred_reports`.
+        Not used when we spawn a debug shell.
+    :param bool as_json: write the exception as one JSON line, via :func:`format_exception_json`,
+        instead of the human-readable text
+    :param ExceptionRateLimiter|bool|None rate_limit: if set, limits how many full reports we write
+        for the same exception (see :func:`get_exception_fingerprint`).
+        True uses a global :class:`ExceptionRateLimiter` with the default settings.
+        Not used when we spawn a debug shell.
+    """
+    if file is None:
+        file = sys.stderr
 
-    # noinspection PyShadowingNames
-    def _some_str(value):
-        """
-        :param object value:
-        :rtype: str
-        """
+    if autodebugshell:
         # noinspection PyBroadException
         try:
-            return str(value)
+            debugshell = int(os.environ["DEBUG"]) != 0
         except Exception:
-            return "<unprintable %s object>" % type(value).__name__
-
-    # noinspection PyShadowingNames
-    def _format_final_exc_line(etype, value):
-        value_str = _some_str(value)
-        if value is None or not value_str:
-            line = color("%s" % etype, color.fg_colors[1])
-        else:
-            line = color("%s" % etype, color.fg_colors[1]) + ": %s" % (value_str,)
-        return line
-
-    # noinspection PyUnresolvedReferences
-    if (
-        isinstance(etype, BaseException)
-        or (hasattr(types, "InstanceType") and isinstance(etype, types.InstanceType))
-        or etype is None
-        or type(etype) is str
-    ):
-        output(_format_final_exc_line(etype, value))
-    else:
-        output(_format_final_exc_line(etype.__name__, value))
+            pass
 
-    for line in output.lines:
-        file.write(line)
-    file.flush()
+    try:
+        if rate_limit and not debugshell:
+            if rate_limit is True:
+                rate_limit = _get_default_exception_rate_limiter()
+            fingerprint = get_exception_fingerprint(etype, value, tb)
+            decision, count = rate_limit.check(fingerprint)
+            output = "".join(rate_limit.pop_digest())
+            if decision != "full":
+                label = _get_exception_label(etype, value, tb)
+                if decision == "summary":
+                    output += "better_exchook: %s [repeated %i times within %.0f secs]\n" % (
+                        label,
+                        count,
+                        rate_limit.window,
+                    )
+                else:
+                    rate_limit.add_suppressed(fingerprint, label)
+                    rate_limit.schedule_digest(file)
+                _clear_exception_frames(value, tb, chain=chain)
+            if output:
+                file.write(output)
+                file.flush()
+            if decision != "full":
+                return
+
+        if deferred and not debugshell:
+            snapshot = ExceptionSnapshot.from_exception(etype, value, tb, limit=limit, chain=chain)
+            fallback = snapshot.type_name + (": " + snapshot.value_str if snapshot.value_str else "") + "\n"
+            if as_json:
+                _get_deferred_writer().submit(file, lambda: format_exception_json(None, snapshot, None), fallback)
+            else:
+                _get_deferred_writer().submit(
+                    file,
+                    lambda: "".join(
+                        format_exception(None, snapshot, None, with_color=with_color, with_preamble=with_preamble)
+                    ),
+                    fallback,
+                )
+            return
 
-    if debugshell:
-        file.write("---------- DEBUG SHELL -----------\n")
+        if as_json:
+            output = format_exception_json(etype, value, tb, limit=limit, chain=chain, clear_frames=not debugshell)
+        else:
+            output = "".join(
+                format_exception(
+                    etype,
+                    value,
+                    tb,
+                    limit=limit,
+                    chain=chain,
+                    with_color=with_color,
+                    with_preamble=with_preamble,
+                    clear_frames=not debugshell,
+                )
+            )
+        # Write all at once, such that the output is not interleaved with other output (e.g. from other threads).
+        file.write(output)
         file.flush()
-        debug_shell(user_ns=all_locals, user_global_ns=all_globals, traceback=tb)
+
+        if debugshell:
+            file.write("---------- DEBUG SHELL -----------\n")
+            file.flush()
+            if limit is None:
+                limit = getattr(sys, "tracebacklimit", None)
+            debug_shell(
+                user_ns=FramesNamespace(tb, "f_locals", limit=limit),
+                user_global_ns=FramesNamespace(tb, "f_globals", limit=limit),
+                traceback=tb,
+            )
+    finally:
+        if cfg_zero_retention:
+            # After the debug shell, or when we did not need the frames at all.
+            release_exception_refs(value, tb)
 
 
-def dump_all_thread_tracebacks(exclude_thread_ids=None, file=None):
+def dump_all_thread_tracebacks(exclude_thread_ids=None, file=None, as_json=False):
     """
     Prints the traceback of all threads.
 
     :param set[int]|list[int]|None exclude_thread_ids: threads to exclude
     :param io.TextIOBase|io.StringIO|typing.TextIO|None file: output stream
+    :param bool as_json: write one JSON line per thread, with the keys "thread_id", "tags" and "frames",
+        where "frames" is like in :func:`format_exception_json` (most recent call first)
     """
     if exclude_thread_ids is None:
         exclude_thread_ids = []
@@ -1597,7 +3152,8 @@ def dump_all_thread_tracebacks(exclude_thread_ids=None, file=None):
     import threading
 
     if hasattr(sys, "_current_frames"):
-        print("", file=file)
+        if not as_json:
+            print("", file=file)
         threads = {t.ident: t for t in threading.enumerate()}
         # noinspection PyProtectedMember
         for tid, stack in sys._current_frames().items():
@@ -1620,10 +3176,22 @@ def dump_all_thread_tracebacks(exclude_thread_ids=None, file=None):
                 tags += [str(thread)]
             else:
                 tags += ["unknown with id %i" % tid]
+            if as_json:
+                snapshot = TracebackSnapshot.from_traceback(stack)
+                file.write(
+                    _json_dumps_line(
+                        {"thread_id": tid, "tags": tags, "frames": [frame.to_dict() for frame in snapshot.frames]}
+                    )
+                )
+                continue
             print("Thread %s:" % ", ".join(tags), file=file)
             print_tb(stack, file=file)
             print("", file=file)
-        print("That were all threads.", file=file)
+        if not as_json:
+            print("That were all threads.", file=file)
+        file.flush()
+    elif as_json:
+        file.write(_json_dumps_line({"error": "Does not have sys._current_frames, cannot get thread tracebacks."}))
     else:
         print("Does not have sys._current_frames, cannot get thread tracebacks.", file=file)
 
@@ -1651,6 +3219,9 @@ def get_func_str_from_code_object(co, frame=None):
     :return: co.co_name as fallback, but maybe sth better like the full func name if possible
     :rtype: str
     """
+    qualname = getattr(co, "co_qualname", None)  # Python >=3.11
+    if qualname:
+        return qualname
     f = get_func_from_code_object(co, frame=frame)
     if f:
         if hasattr(f, "__qualname__"):
@@ -1659,7 +3230,12 @@ def get_func_str_from_code_object(co, frame=None):
     return co.co_name
 
 
-_func_from_code_object_cache = WeakKeyDictionary()  # code object -> function
+# id(code object) -> (weakref to code object, weakref to function).
+# Weak on both sides, as functions can keep a lot alive (closure cells, __globals__, dynamically created classes).
+_func_from_code_object_cache = _LruCache(max_size=1000)
+_func_from_code_object_index = WeakKeyDictionary()  # code object -> weakref to function, see _index_module_functions
+# module name -> ids of the module dict values when it was indexed (so we notice any replaced value)
+_func_from_code_object_index_modules = {}
 
 
 def get_func_from_code_object(co, frame=None):
@@ -1669,18 +3245,21 @@ def get_func_from_code_object(co, frame=None):
     :return: function, such that ``func.__code__ is co``, or None
     :rtype: types.FunctionType
 
-    This is CPython specific (to some degree; it uses the `gc` module to find references).
+    We look at the class of ``self`` of the frame (if given),
+    then we resolve ``co.co_qualname`` (Python >=3.11) in the module of ``co.co_filename``,
+    and otherwise we look it up in an index of all functions in that module (including class dicts).
+    We never scan the whole heap (e.g. via :func:`gc.get_referrers`), as this can be very slow.
+    Thus, e.g. closures will not be found.
     Inspired from:
     https://stackoverflow.com/questions/12787108/getting-the-python-function-for-a-code-object
     https://stackoverflow.com/questions/54656758/get-function-object-from-stack-frame-object
     """
-    import gc
     import types
 
     assert isinstance(co, (types.CodeType, DummyFrame))
     co_is_code_object = isinstance(co, types.CodeType)
     if co_is_code_object:
-        candidate = _func_from_code_object_cache.get(co)
+        candidate = _get_cached_func_from_code_object(co)
         if candidate:
             return candidate
     _attr_name = "__code__" if PY3 else "func_code"
@@ -1691,27 +3270,167 @@ def get_func_from_code_object(co, frame=None):
             candidate = getattr(frame_self.__class__, func_name, None)
             if candidate and (getattr(candidate, _attr_name, None) is co or isinstance(co, DummyFrame)):
                 if co_is_code_object:
-                    _func_from_code_object_cache[co] = candidate
+                    _cache_func_from_code_object(co, candidate)
                 return candidate
     try:
-        candidate = getattr(_get_loaded_module_from_filename(co.co_filename), co.co_name, None)
+        mod = _get_loaded_module_from_filename(co.co_filename)
     except ImportError:  # some modules have lazy loaders, but those might fail here
-        candidate = None
-    if candidate and (getattr(candidate, _attr_name, None) is co or isinstance(co, DummyFrame)):
-        if co_is_code_object:
-            _func_from_code_object_cache[co] = candidate
-        return candidate
+        mod = None
+    if mod is None:
+        return None
     if isinstance(co, DummyFrame):
+        try:
+            return getattr(mod, co.co_name, None)
+        except ImportError:
+            return None
+    candidate = None
+    for candidate in _iter_funcs_from_obj(_get_obj_by_qualname(mod, getattr(co, "co_qualname", co.co_name))):
+        if candidate.__code__ is co:
+            break
+    else:
+        candidate = _get_func_from_code_object_index(co, mod)
+    if candidate:
+        _cache_func_from_code_object(co, candidate)
+    return candidate
+
+
+def _get_cached_func_from_code_object(co):
+    """
+    :param types.CodeType co:
+    :return: function from :data:`_func_from_code_object_cache`, or None if not cached or not alive anymore
+    :rtype: types.FunctionType|None
+    """
+    entry = _func_from_code_object_cache.get(id(co))
+    if entry is None:
         return None
-    candidates = gc.get_referrers(co)
-    candidates = [f for f in candidates if getattr(f, _attr_name, None) is co]
-    if candidates:
-        _func_from_code_object_cache[co] = candidates[0]
-        return candidates[0]
-    return None
+    co_ref, func_ref = entry
+    if co_ref() is not co:  # the id was reused
+        return None
+    return func_ref()
+
+
+def _cache_func_from_code_object(co, func):
+    """
+    :param types.CodeType co:
+    :param types.FunctionType|typing.Any func:
+    """
+    try:
+        entry = (weakref.ref(co), weakref.ref(func))
+    except TypeError:  # not weak-referenceable
+        return
+    _func_from_code_object_cache.put(id(co), entry)
+
+
+def _get_obj_by_qualname(obj, qualname):
+    """
+    :param typing.Any obj: e.g. module
+    :param str qualname: e.g. "A.f"
+    :return: obj.A.f, or None
+    :rtype: typing.Any
+    """
+    for name in qualname.split("."):
+        if name == "<locals>":
+            return None
+        try:
+            obj = getattr(obj, name, None)
+        except ImportError:  # some modules have lazy loaders, but those might fail here
+            return None
+        if obj is None:
+            return None
+    return obj
+
+
+def _iter_funcs_from_obj(obj):
+    """
+    :param typing.Any obj: e.g. function, method, classmethod, staticmethod, property, decorated function
+    :return: yields all functions which are directly reachable from obj, like ``obj.__func__``, ``obj.fget``, etc
+    :rtype: typing.Iterator[types.FunctionType]
+    """
+    if obj is None:
+        return
+    if isinstance(obj, property):
+        for func in (obj.fget, obj.fset, obj.fdel):
+            for func_ in _iter_funcs_from_obj(func):
+                yield func_
+        return
+    if isinstance(obj, (types.MethodType, classmethod, staticmethod)):
+        obj = obj.__func__
+    visited = 0
+    while isinstance(obj, types.FunctionType) and visited < 10:  # also follow decorators via __wrapped__
+        yield obj
+        obj = getattr(obj, "__wrapped__", None)
+        visited += 1
+
+
+def _get_func_from_code_object_index(co, mod):
+    """
+    :param types.CodeType co:
+    :param types.ModuleType mod: module of ``co.co_filename``
+    :return: function, such that ``func.__code__ is co``, or None
+    :rtype: types.FunctionType|None
+    """
+    mod_name = getattr(mod, "__name__", None)
+    mod_dict = getattr(mod, "__dict__", None)
+    if not isinstance(mod_name, str) or not isinstance(mod_dict, dict):
+        return None
+    func = _get_indexed_func_from_code_object(co)
+    if func is not None:
+        return func
+    mod_dict_version = tuple(map(id, list(mod_dict.values())))
+    if _func_from_code_object_index_modules.get(mod_name) != mod_dict_version:
+        _func_from_code_object_index_modules[mod_name] = mod_dict_version
+        _index_module_functions(mod_name, mod_dict)
+        func = _get_indexed_func_from_code_object(co)
+    return func
+
+
+def _get_indexed_func_from_code_object(co):
+    """
+    :param types.CodeType co:
+    :return: function from :data:`_func_from_code_object_index`, or None if not indexed, not alive anymore,
+        or its code was replaced in the meantime
+    :rtype: types.FunctionType|None
+    """
+    func_ref = _func_from_code_object_index.get(co)
+    if func_ref is None:
+        return None
+    func = func_ref()
+    if func is None or func.__code__ is not co:
+        return None
+    return func
+
+
+def _index_module_functions(mod_name, mod_dict):
+    """
+    Adds all functions from the module dict and all class dicts of classes from this module
+    to :data:`_func_from_code_object_index`.
+
+    :param str mod_name:
+    :param dict[str,typing.Any] mod_dict:
+    """
+    visited_classes = set()
+    queue = [list(mod_dict.values())]
+    while queue:
+        for obj in queue.pop():
+            if isinstance(obj, type):
+                if id(obj) in visited_classes or getattr(obj, "__module__", None) != mod_name:
+                    continue
+                visited_classes.add(id(obj))
+                queue.append(list(vars(obj).values()))
+                continue
+            for func in _iter_funcs_from_obj(obj):
+                if _get_indexed_func_from_code_object(func.__code__) is None:
+                    _func_from_code_object_index[func.__code__] = weakref.ref(func)
 
 
 _loaded_module_from_filename_cache = {}  # filename -> module name
+_loaded_module_from_filename_indexed = {}  # module name -> id(module) when it was indexed
+# filename -> _loaded_module_from_filename_index_version when not found
+_loaded_module_from_filename_misses = _LruCache(max_size=1000)
+_loaded_module_files_by_basename = {}  # basename -> module filenames, in order of sys.modules
+_loaded_module_from_filename_index_version = 0  # increased whenever modules were added to or removed from sys.modules
+_loaded_module_from_filename_index_sys_modules_key = None  # see _get_sys_modules_key, when it was indexed
+_loaded_module_from_filename_index_lock = threading.RLock()
 
 
 def _get_loaded_module_from_filename(filename):
@@ -1725,19 +3444,73 @@ def _get_loaded_module_from_filename(filename):
         filename = filename[:-1]
     if filename in _loaded_module_from_filename_cache:
         return sys.modules.get(_loaded_module_from_filename_cache[filename])
-    # Update the filename to module name cache and check yet again
-    # Copy sys.modules in order to cope with changes while iterating
-    for modname, module in sys.modules.copy().items():
-        f = getattr(module, "__file__", None)
-        if f:
-            if f.endswith(".pyc") or f.endswith(".pyo"):
-                f = f[:-1]
-            _loaded_module_from_filename_cache[f] = modname
+    # Filenames like "<string>" never match. Only check again when sys.modules changed.
+    version = _update_loaded_module_from_filename_index()
+    if _loaded_module_from_filename_misses.get(filename) == version:
+        return None
     if filename in _loaded_module_from_filename_cache:
         return sys.modules.get(_loaded_module_from_filename_cache[filename])
+    _loaded_module_from_filename_misses.put(filename, version)
     return None
 
 
+def _update_loaded_module_from_filename_index():
+    """
+    When some module was added to or removed from sys.modules since the last update,
+    adds the new modules (and the ones which were replaced in the meantime)
+    to :data:`_loaded_module_from_filename_cache` and :data:`_loaded_module_files_by_basename`.
+    Otherwise, this does not walk through sys.modules,
+    i.e. a module which was only replaced under the same name is not noticed here.
+
+    :return: :data:`_loaded_module_from_filename_index_version`
+    :rtype: int
+    """
+    global _loaded_module_from_filename_index_version, _loaded_module_from_filename_index_sys_modules_key
+    sys_modules_key = _get_sys_modules_key()
+    if sys_modules_key == _loaded_module_from_filename_index_sys_modules_key:
+        return _loaded_module_from_filename_index_version
+    with _loaded_module_from_filename_index_lock:
+        if sys_modules_key == _loaded_module_from_filename_index_sys_modules_key:  # another thread updated it
+            return _loaded_module_from_filename_index_version
+        # Copy sys.modules in order to cope with changes while iterating
+        modules = dict(sys.modules)
+        for modname in list(_loaded_module_from_filename_indexed.keys()):
+            if modname not in modules:
+                del _loaded_module_from_filename_indexed[modname]
+        for modname, module in modules.items():
+            if _loaded_module_from_filename_indexed.get(modname) == id(module):
+                continue
+            _loaded_module_from_filename_indexed[modname] = id(module)
+            f = getattr(module, "__file__", None)
+            if f and isinstance(f, str):
+                if f.endswith(".pyc") or f.endswith(".pyo"):
+                    f = f[:-1]
+                _loaded_module_from_filename_cache[f] = modname
+                files = _loaded_module_files_by_basename.setdefault(os.path.basename(f), [])
+                if f not in files:
+                    files.append(f)
+        _loaded_module_from_filename_index_version += 1
+        # Only publish the key once the index is complete, such that other threads do not see a partial index.
+        _loaded_module_from_filename_index_sys_modules_key = sys_modules_key
+        return _loaded_module_from_filename_index_version
+
+
+def _get_sys_modules_key():
+    """
+    :return: some key which changes whenever a module is added to or removed from sys.modules.
+        sys.modules is ordered, and new modules are always added at the end,
+        so we don't need to look at all the module names for this.
+    :rtype: typing.Hashable
+    """
+    try:
+        last_modname = next(reversed(sys.modules))
+    except TypeError:  # Python <3.8, dicts are not reversible
+        return frozenset(sys.modules)
+    except StopIteration:
+        return None
+    return len(sys.modules), last_modname, id(sys.modules.get(last_modname))
+
+
 def iter_traceback(tb=None, enforce_most_recent_call_first=False):
     """
     Iterates a traceback of various formats:
@@ -1774,26 +3547,40 @@ def iter_traceback(tb=None, enforce_most_recent_call_first=False):
             yield frame
         return
 
+    for frame, _ in _iter_traceback_entries(tb):
+        yield frame
+
+
+def _iter_traceback_entries(tb):
+    """
+    Like :func:`iter_traceback`, but also yields the line number,
+    and does not check or reorder anything.
+    This is linear in the number of frames, also for a :class:`StackSummary`.
+
+    :param types.TracebackType|types.FrameType|StackSummary|TracebackSnapshot tb:
+    :return: yields (frame, lineno)
+    :rtype: typing.Iterator[typing.Tuple[types.FrameType|DummyFrame|FrameSnapshot,int]]
+    """
+    if isinstance(tb, TracebackSnapshot):
+        for frame_snapshot in tb.frames:
+            yield frame_snapshot, frame_snapshot.lineno
+        return
+    if isinstance(tb, StackSummary):
+        for frame_summary in tb:
+            if isinstance(frame_summary, ExtendedFrameSummary) and frame_summary.tb_frame is not None:
+                yield frame_summary.tb_frame, frame_summary.lineno
+            elif isinstance(frame_summary, SnapshotFrameSummary):
+                yield frame_summary.snapshot, frame_summary.lineno
+            else:
+                yield DummyFrame.from_frame_summary(frame_summary), frame_summary.lineno
+        return
     _tb = tb
     while _tb is not None:
-        if is_frame(_tb):
-            frame = _tb
-        elif is_stack_summary(_tb):
-            _tb0 = _tb[0]
-            if isinstance(_tb0, ExtendedFrameSummary):
-                frame = _tb0.tb_frame
-            else:
-                frame = DummyFrame.from_frame_summary(_tb0)
-        else:
-            frame = _tb.tb_frame
-        yield frame
-        if is_frame(_tb):
+        if inspect.isframe(_tb):
+            yield _tb, _tb.f_lineno
             _tb = _tb.f_back
-        elif is_stack_summary(_tb):
-            _tb = StackSummary.from_list(_tb[1:])
-            if not _tb:
-                _tb = None
         else:
+            yield _tb.tb_frame, _tb.tb_lineno
             _tb = _tb.tb_next
 
 
@@ -1807,12 +3594,14 @@ class ExtendedFrameSummary(FrameSummary):
         self.tb_frame = frame
 
     def __reduce__(self):
-        # We deliberately serialize this as just a FrameSummary,
-        # excluding the tb_frame, as this cannot be serialized (via pickle at least),
+        # We deliberately exclude the tb_frame, as this cannot be serialized (via pickle at least),
         # and also we do not want this to be serialized.
-        # We also exclude _line and locals as it's not so easy to add them here,
-        # and also not so important.
-        return FrameSummary, (self.filename, self.lineno, self.name)
+        # Instead, we serialize a compact snapshot of it (source code, variable reprs),
+        # such that it can be formatted e.g. in another process.
+        if self.tb_frame is None:
+            return FrameSummary, (self.filename, self.lineno, self.name)
+        snapshot = FrameSnapshot.from_frame(self.tb_frame, self.lineno, with_vars=not _get_vars_unsafe_reason())
+        return SnapshotFrameSummary, (snapshot,)
 
 
 class DummyFrame:
@@ -1849,6 +3638,292 @@ class DummyFrame:
         self.f_locals = None
 
 
+class FrameSnapshot:
+    """
+    Compact snapshot of a frame, with everything :func:`format_tb` needs to render it:
+    the source code of the statement and the (bounded) reprs of the variables referenced in it.
+    It does not keep any reference to the frame or to any of the variables.
+    """
+
+    __slots__ = ("filename", "lineno", "name", "source_code", "variables")
+
+    def __init__(self, filename, lineno, name, source_code=None, variables=None):
+        """
+        :param str filename:
+        :param int lineno:
+        :param str name: function name, as we print it
+        :param str|None source_code: the statement at lineno, without indentation
+        :param tuple[tuple[tuple[str,...],str|None,str|None,bool]]|None variables:
+            (token, scope, repr, truncated) for each variable.
+            scope is "local", "global", "builtin", or None if not found, like in :func:`_iter_frame_vars`.
+            truncated is whether the repr was cut to :func:`output_limit`.
+            None if the variables were not captured.
+        """
+        self.filename = filename
+        self.lineno = lineno
+        self.name = name
+        self.source_code = source_code
+        self.variables = variables
+
+    def __repr__(self):
+        return "<%s %s:%i in %s>" % (self.__class__.__name__, self.filename, self.lineno, self.name)
+
+    def __reduce__(self):
+        return FrameSnapshot, (self.filename, self.lineno, self.name, self.source_code, self.variables)
+
+    def to_dict(self):
+        """
+        :return: JSON-serializable dict, see :func:`format_exception_json`
+        :rtype: dict[str,typing.Any]
+        """
+        d = {"filename": self.filename, "lineno": self.lineno, "name": self.name, "source": self.source_code}
+        if self.variables is not None:
+            d["vars"] = [
+                {"name": ".".join(token), "scope": scope, "repr": token_repr, "truncated": truncated}
+                for token, scope, token_repr, truncated in self.variables
+            ]
+        return d
+
+    @classmethod
+    def from_frame(cls, f, lineno, with_vars=True, deadline=None):
+        """
+        :param types.FrameType|DummyFrame f:
+        :param int lineno:
+        :param bool with_vars: whether to capture the variables
+        :param float|None deadline: time.monotonic(). after that, the variables are not rendered anymore
+        :rtype: FrameSnapshot
+        """
+        co = f.f_code
+        filename = co.co_filename
+        if not source_file_exists(filename):
+            alt_fn = fallback_findfile(filename)
+            if alt_fn:
+                filename = alt_fn
+        name = get_func_str_from_code_object(co, frame=f)
+        source_code = get_source_code(filename, lineno, f.f_globals)
+        variables = None
+        if source_code:
+            source_code = remove_indent_lines(replace_tab_indents(source_code)).rstrip()
+            if with_vars and not (isinstance(f, DummyFrame) and not f.have_vars_available):
+                variables = []
+                for token, scope, obj, exc in _iter_frame_vars(f, co, lineno, source_code):
+                    if cfg_max_vars_per_frame is not None and len(variables) >= cfg_max_vars_per_frame:
+                        break
+                    if scope is None:
+                        variables.append((token, None, None, False))
+                    elif exc is not None:
+                        variables.append((token, scope, _format_var_exception(exc), False))
+                    elif deadline is not None and time.monotonic() > deadline:
+                        variables.append((token, scope, _time_budget_exceeded_str, False))
+                    else:
+                        variables.append((token, scope) + _format_obj_plain(obj))
+                variables = tuple(variables)
+        return cls(filename=filename, lineno=lineno, name=name, source_code=source_code or None, variables=variables)
+
+
+class TracebackSnapshot:
+    """
+    Snapshot of a traceback (or stack), as a sequence of :class:`FrameSnapshot`.
+    This can be passed to :func:`format_tb` like a traceback.
+    """
+
+    __slots__ = ("frames", "most_recent_call_first")
+
+    def __init__(self, frames, most_recent_call_first=False):
+        """
+        :param tuple[FrameSnapshot] frames:
+        :param bool most_recent_call_first: e.g. when captured from a frame or :class:`StackSummary`
+        """
+        self.frames = frames
+        self.most_recent_call_first = most_recent_call_first
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return "<%s with %i frames>" % (self.__class__.__name__, len(self.frames))
+
+    def __reduce__(self):
+        return TracebackSnapshot, (self.frames, self.most_recent_call_first)
+
+    @classmethod
+    def from_traceback(cls, tb, limit=None, with_vars=None, clear_frames=False, deadline=None):
+        """
+        :param types.TracebackType|types.FrameType|StackSummary tb:
+        :param int|None limit: like in :func:`format_tb`
+        :param bool|None with_vars: like in :func:`format_tb`
+        :param bool clear_frames: like in :func:`format_tb`
+        :param float|None deadline: time.monotonic(). by default, from ``cfg_max_render_time``.
+            after that, the variables are not rendered anymore.
+        :rtype: TracebackSnapshot
+        """
+        if deadline is None and cfg_max_render_time is not None:
+            deadline = time.monotonic() + cfg_max_render_time
+        if limit is None:
+            limit = getattr(sys, "tracebacklimit", None)
+        if with_vars is None:
+            with_vars = not _get_vars_unsafe_reason()
+        entries = []
+        for entry in _iter_traceback_entries(tb):
+            if limit is not None and len(entries) >= limit:
+                break
+            entries.append(entry)
+        # format_tb will not show the skipped frames, so we do not need their variables.
+        skipped = set()
+        for start, (end, _) in _get_frames_skip_ranges(entries).items():
+            skipped.update(range(start, end))
+        frames = []
+        for i, (f, lineno) in enumerate(entries):
+            if deadline is not None and time.monotonic() > deadline:
+                with_vars = False
+            frames.append(
+                FrameSnapshot.from_frame(f, lineno, with_vars=with_vars and i not in skipped, deadline=deadline)
+            )
+            if clear_frames:
+                _clear_frame(f)
+        return cls(tuple(frames), most_recent_call_first=inspect.isframe(tb) or isinstance(tb, StackSummary))
+
+
+class ExceptionSnapshot:
+    """
+    Snapshot of an exception, with its traceback (:class:`TracebackSnapshot`) and chained exceptions.
+    This can be passed to :func:`format_exception` as the exception value.
+    """
+
+    __slots__ = ("type_name", "value_str", "tb", "cause", "context", "syntax_error")
+
+    def __init__(self, type_name, value_str, tb=None, cause=None, context=None, syntax_error=None):
+        """
+        :param str type_name:
+        :param str value_str: str of the exception, can be empty
+        :param TracebackSnapshot|None tb:
+        :param ExceptionSnapshot|None cause: __cause__
+        :param ExceptionSnapshot|None context: __context__, only if there is no cause
+        :param tuple[str,str|None,int,int|None,str|None]|None syntax_error: see :func:`_get_syntax_error_info`
+        """
+        self.type_name = type_name
+        self.value_str = value_str
+        self.tb = tb
+        self.cause = cause
+        self.context = context
+        self.syntax_error = syntax_error
+
+    def __str__(self):
+        return self.value_str
+
+    def __repr__(self):
+        return "<%s %s: %s>" % (self.__class__.__name__, self.type_name, self.value_str)
+
+    def __reduce__(self):
+        return ExceptionSnapshot, (
+            self.type_name,
+            self.value_str,
+            self.tb,
+            self.cause,
+            self.context,
+            self.syntax_error,
+        )
+
+    def to_dict(self):
+        """
+        :return: JSON-serializable dict, see :func:`format_exception_json`
+        :rtype: dict[str,typing.Any]
+        """
+        chain = []
+        exc = self
+        while exc is not None:
+            link = "cause" if exc.cause is not None else "context" if exc.context is not None else None
+            d = {"type": exc.type_name, "value": exc.value_str, "link": link}
+            d["frames"] = [frame.to_dict() for frame in exc.tb.frames] if exc.tb is not None else None
+            if exc.syntax_error:
+                filename, alt_filename, lineno, offset, source_code = exc.syntax_error
+                d["syntax_error"] = {
+                    "filename": alt_filename or filename,
+                    "lineno": lineno,
+                    "offset": offset,
+                    "source": source_code,
+                }
+            chain.append(d)
+            exc = exc.cause if exc.cause is not None else exc.context
+        chain.reverse()  # oldest first, like in the text output
+        return {"type": self.type_name, "value": self.value_str, "chain": chain}
+
+    @classmethod
+    def from_exception(cls, etype, value, tb, limit=None, chain=True, clear_frames=True, deadline=None):
+        """
+        :param etype: exception type
+        :param value: exception value
+        :param tb: traceback
+        :param int|None limit: like in :func:`format_tb`
+        :param bool chain: whether to include the chain of exceptions
+        :param bool clear_frames: like in :func:`format_tb`
+        :param float|None deadline: time.monotonic(), for everything, including the chained exceptions.
+            by default, from ``cfg_max_render_time``
+        :rtype: ExceptionSnapshot
+        """
+        if deadline is None and cfg_max_render_time is not None:
+            deadline = time.monotonic() + cfg_max_render_time
+        # The chained exceptions usually share some frames with us, thus we clear the frames only at the end,
+        # like format_exception.
+        tb_snapshot = None
+        if tb is not None:
+            tb_snapshot = TracebackSnapshot.from_traceback(tb, limit=limit, clear_frames=False, deadline=deadline)
+        cause, context = None, None
+        if chain:
+            if getattr(value, "__cause__", None):
+                cause = cls.from_exception(
+                    type(value.__cause__),
+                    value.__cause__,
+                    value.__cause__.__traceback__,
+                    clear_frames=False,
+                    deadline=deadline,
+                )
+            elif getattr(value, "__context__", None):
+                context = cls.from_exception(
+                    type(value.__context__),
+                    value.__context__,
+                    value.__context__.__traceback__,
+                    clear_frames=False,
+                    deadline=deadline,
+                )
+        if clear_frames:
+            _clear_exception_frames(value, tb, chain=chain)
+        type_name, value_str = _get_exc_type_name_and_str(etype, value)
+        return cls(
+            type_name=type_name,
+            value_str=value_str,
+            tb=tb_snapshot,
+            cause=cause,
+            context=context,
+            syntax_error=_get_syntax_error_info(value) if isinstance(value, SyntaxError) else None,
+        )
+
+
+class SnapshotFrameSummary(FrameSummary):
+    """
+    :class:`FrameSummary` with a :class:`FrameSnapshot`.
+    This is what :class:`ExtendedFrameSummary` becomes when it is pickled,
+    and :func:`format_tb` renders it like the original frame.
+    """
+
+    __slots__ = ("snapshot",)
+
+    def __init__(self, snapshot):
+        """
+        :param FrameSnapshot snapshot:
+        """
+        super(SnapshotFrameSummary, self).__init__(
+            snapshot.filename, snapshot.lineno, snapshot.name, lookup_line=False, line=snapshot.source_code
+        )
+        self.snapshot = snapshot
+
+    def __reduce__(self):
+        return SnapshotFrameSummary, (self.snapshot,)
+
+
 # noinspection PyPep8Naming,PyUnusedLocal
 def _StackSummary_extract(frame_gen, limit=None, lookup_lines=True, capture_locals=False):
     """
@@ -1878,18 +3953,184 @@ def _StackSummary_extract(frame_gen, limit=None, lookup_lines=True, capture_loca
     return result
 
 
+# noinspection PyPep8Naming,PyUnusedLocal
+def _StackSummary_extract_snapshot(frame_gen, limit=None, lookup_lines=True, capture_locals=False):
+    """
+    Replacement for :func:`StackSummary.extract`, like :func:`_StackSummary_extract`,
+    but this captures a :class:`FrameSnapshot` (source code, bounded variable reprs) of every frame right away,
+    and does not keep any reference to the frames.
+    Thus, this does not keep the locals alive, but it is more expensive at extract time.
+
+    :param frame_gen: A generator that yields (frame, lineno) tuples to include in the stack.
+    :param int|None limit: None to include all frames or the number of frames to include.
+        If negative, like for the original, this includes the last ``abs(limit)`` frames.
+    :param lookup_lines: ignored. the source code is always captured
+    :param capture_locals: ignored. the variables are always captured (as bounded reprs)
+    """
+    import itertools
+
+    if limit is not None:
+        if limit >= 0:
+            frame_gen = itertools.islice(frame_gen, limit)
+        else:
+            frame_gen = collections.deque(frame_gen, maxlen=-limit)
+    with_vars = not _get_vars_unsafe_reason()
+    result = StackSummary()
+    for f, lineno in frame_gen:
+        result.append(SnapshotFrameSummary(FrameSnapshot.from_frame(f, lineno, with_vars=with_vars)))
+    return result
+
+
+class NotEvaluatedAttrib:
+    """
+    Placeholder for an attribute which was not evaluated because this would execute arbitrary code,
+    e.g. a property or ``__getattr__``. See ``cfg_static_attribute_lookup``.
+    """
+
+    __slots__ = ("kind",)
+
+    def __init__(self, kind):
+        """
+        :param str kind: e.g. "property"
+        """
+        self.kind = kind
+
+    def __repr__(self):
+        return "<%s, not evaluated>" % self.kind
+
+
+# Descriptors which are implemented in C and just bind or read a value, i.e. which are safe to evaluate.
+_static_safe_descriptor_types = (
+    types.FunctionType,
+    types.MemberDescriptorType,  # __slots__
+    types.GetSetDescriptorType,
+    getattr(types, "MethodDescriptorType", types.FunctionType),
+    getattr(types, "WrapperDescriptorType", types.FunctionType),
+    getattr(types, "ClassMethodDescriptorType", types.FunctionType),
+)
+
+
+def getattr_static(obj, attr_name):
+    """
+    Like :func:`getattr`, but like :func:`inspect.getattr_static`, this does not execute any code of the object,
+    i.e. no properties, custom descriptors, ``__getattr__`` or ``__getattribute__``.
+    It looks into the instance dict, slots, and class attributes.
+    Functions and other builtin descriptors are bound as usual.
+    Other descriptors result in a :class:`NotEvaluatedAttrib`.
+
+    :param typing.Any obj:
+    :param str attr_name:
+    :return: the attribute, or :class:`NotEvaluatedAttrib`
+    :raises AttributeError: if not found
+    """
+    try:
+        value = inspect.getattr_static(obj, attr_name)
+    except AttributeError:
+        if not isinstance(obj, type) and _has_static_class_attrib(type(obj), "__getattr__"):
+            return NotEvaluatedAttrib("__getattr__")
+        if isinstance(obj, types.ModuleType) and "__getattr__" in _get_static_instance_dict(obj):
+            return NotEvaluatedAttrib("__getattr__")
+        raise
+    if not hasattr(type(value), "__get__"):
+        return value  # plain value, no descriptor
+    if isinstance(obj, type):
+        if _has_static_class_attrib(obj, attr_name):
+            instance, owner = None, obj
+        else:  # from the metaclass
+            instance, owner = obj, type(obj)
+    else:
+        if _get_static_instance_dict(obj).get(attr_name, None) is value:
+            return value  # instance attribs are not bound
+        instance, owner = obj, type(obj)
+    if isinstance(value, staticmethod):
+        return value.__func__
+    if isinstance(value, classmethod):
+        return types.MethodType(value.__func__, owner)
+    if isinstance(value, _static_safe_descriptor_types):
+        return value.__get__(instance, owner)
+    return NotEvaluatedAttrib("property" if isinstance(value, property) else type(value).__name__)
+
+
+def _has_static_class_attrib(cls, attr_name):
+    """
+    :param type cls:
+    :param str attr_name:
+    :return: whether the attrib is defined in the class dict of cls or any of its bases, without executing code
+    :rtype: bool
+    """
+    for base in type.__dict__["__mro__"].__get__(cls):
+        if attr_name in type.__dict__["__dict__"].__get__(base):
+            return True
+    return False
+
+
+def _get_static_instance_dict(obj):
+    """
+    :param typing.Any obj:
+    :return: obj.__dict__, without executing code of the object, or an empty dict if there is none
+    :rtype: dict[str,typing.Any]
+    """
+    try:
+        d = object.__getattribute__(obj, "__dict__")
+    except AttributeError:
+        return {}
+    return d if isinstance(d, dict) else {}
+
+
+def _get_attrib(obj, attr_name):
+    """
+    :param typing.Any obj:
+    :param str attr_name:
+    :return: the attrib via :func:`getattr` or :func:`getattr_static`, depending on ``cfg_static_attribute_lookup``
+    :raises AttributeError: if not found
+    """
+    if cfg_static_attribute_lookup:
+        return getattr_static(obj, attr_name)
+    return getattr(obj, attr_name)
+
+
+def _get_attrib_or_none(obj, attr_name):
+    """
+    :param typing.Any obj:
+    :param str attr_name:
+    :return: like :func:`_get_attrib`, or None if not found or evaluating it failed
+    """
+    # noinspection PyBroadException
+    try:
+        return _get_attrib(obj, attr_name)
+    except Exception:
+        return None
+
+
+def _unwrap(func):
+    """
+    Like :func:`inspect.unwrap`, but this gets ``__wrapped__`` via :func:`_get_attrib`,
+    i.e. this does not execute code of the object when ``cfg_static_attribute_lookup`` is set.
+
+    :param typing.Any func:
+    :return: the innermost wrapped object, or func itself
+    :rtype: typing.Any
+    """
+    visited = {id(func)}
+    while True:
+        wrapped = _get_attrib_or_none(func, "__wrapped__")
+        if wrapped is None or isinstance(wrapped, NotEvaluatedAttrib) or id(wrapped) in visited:
+            return func
+        visited.add(id(wrapped))
+        func = wrapped
+
+
 def _is_bound_method(obj, attr_name):
     if not PY3:
         return False  # not properly supported in Python 2
 
-    meth = getattr(obj, attr_name, None)
-    meth = inspect.unwrap(meth)
+    meth = _unwrap(_get_attrib_or_none(obj, attr_name))
 
     if isinstance(meth, types.MethodType):
         if meth.__self__ is not obj:
             return False
         cls = type(obj)
-        func = getattr(cls, attr_name, None)
+        func = _get_attrib_or_none(cls, attr_name)
         return meth.__func__ is func
 
     elif isinstance(meth, (types.BuiltinMethodType, getattr(types, "MethodWrapperType", types.BuiltinMethodType))):
@@ -1907,7 +4148,7 @@ def _is_module_function(obj, attr_name, obj_is_dict=False):
     else:
         if not isinstance(obj, types.ModuleType):
             return False
-        func = getattr(obj, attr_name, None)
+        func = _get_attrib_or_none(obj, attr_name)
     return isinstance(func, types.FunctionType)
 
 
@@ -1917,18 +4158,25 @@ def _is_module_class(obj, attr_name, obj_is_dict=False):
     else:
         if not isinstance(obj, types.ModuleType):
             return False
-        cls = getattr(obj, attr_name, None)
+        cls = _get_attrib_or_none(obj, attr_name)
     return isinstance(cls, type)
 
 
-def install():
+def install(**kwargs):
     """
     Replaces sys.excepthook by our better_exchook.
+
+    :param kwargs: options for :func:`better_exchook`, e.g. ``deferred=True``
     """
-    sys.excepthook = better_exchook
+    if kwargs:
+        import functools
+
+        sys.excepthook = functools.partial(better_exchook, **kwargs)
+    else:
+        sys.excepthook = better_exchook
 
 
-def replace_traceback_format_tb():
+def replace_traceback_format_tb(snapshot=False):
     """
     Replaces these functions from the traceback module by our own:
 
@@ -1938,13 +4186,43 @@ def replace_traceback_format_tb():
 
     Note that this kind of monkey patching might not be safe under all circumstances
     and is not officially supported by Python.
+
+    :param bool snapshot: if True, ``StackSummary.extract`` captures a snapshot (source code, variable reprs)
+        of every frame right away, and does not keep references to the frames (and thus their locals),
+        see :func:`_StackSummary_extract_snapshot`.
+        Otherwise, it keeps the frames, and the variables are formatted later, when the stack is formatted.
     """
     import traceback
 
     traceback.format_tb = format_tb
     if hasattr(traceback, "StackSummary"):
         traceback.StackSummary.format = format_tb
-        traceback.StackSummary.extract = _StackSummary_extract
+        traceback.StackSummary.extract = _StackSummary_extract_snapshot if snapshot else _StackSummary_extract
+
+
+@contextlib.contextmanager
+def replaced_traceback_format_tb(snapshot=True):
+    """
+    Like :func:`replace_traceback_format_tb`, but only within the context, and restores the original functions after.
+    Note that the patch still applies to all threads while the context is active.
+
+    :param bool snapshot: see :func:`replace_traceback_format_tb`. by default, no frames are kept
+    """
+    import traceback
+
+    old_format_tb = traceback.format_tb
+    old_stack_summary_attribs = (
+        {name: vars(traceback.StackSummary)[name] for name in ("format", "extract")}
+        if hasattr(traceback, "StackSummary")
+        else {}
+    )
+    replace_traceback_format_tb(snapshot=snapshot)
+    try:
+        yield
+    finally:
+        traceback.format_tb = old_format_tb
+        for name, value in old_stack_summary_attribs.items():
+            setattr(traceback.StackSummary, name, value)
 
 
 def replace_traceback_print_tb():
@@ -33,6 +33,133 @@ def test_parse_py_statement():
     assert list(better_exchook.parse_py_statement('"hello\\n"')) == [("str", "hello\n")]
 
 
+def _parse_py_statement_reference(line):
+    """
+    The original simple state machine implementation of :func:`better_exchook.parse_py_statement`.
+    We keep it here as a reference, to test the optimized implementation against it.
+
+    :param str line:
+    :return: yields (type, value)
+    :rtype: typing.Iterator[typing.Tuple[str,str]]
+    """
+    state = 0
+    cur_token = ""
+    str_prefix = None
+    str_is_f_string = False  # whether we are in an f-string
+    str_quote = None
+    f_str_expr_opening_brackets = 0
+    spaces = " \t\n"
+    ops = ".,;:+-*/%&!=|(){}[]^<>"
+    i = 0
+
+    def _escape_char(_c):
+        if _c == "n":
+            return "\n"
+        elif _c == "t":
+            return "\t"
+        else:
+            return _c
+
+    while i < len(line):
+        c = line[i]
+        i += 1
+        if state == 0:
+            if c in spaces:
+                pass
+            elif c in ops:
+                yield "op", c
+            elif c == "#":
+                state = 6
+            elif c in "\"'":
+                state = 1
+                str_prefix = None
+                str_is_f_string = False
+                str_quote = c
+                cur_token = ""
+            else:
+                cur_token = c
+                state = 3  # identifier
+        elif state == 1:  # string
+            if c == "\\":
+                cur_token += _escape_char(line[i : i + 1])
+                i += 1
+            elif c == str_quote:
+                yield "str" if not str_prefix else "%s-str" % str_prefix, cur_token
+                cur_token = ""
+                state = 0
+            elif str_is_f_string and c == "{":  # f-string
+                if line[i - 1 : i + 1] == "{{":
+                    cur_token += "{"
+                    i += 1
+                else:
+                    yield "str" if not str_prefix else "%s-str" % str_prefix, cur_token
+                    yield "f-str-expr-open", "{"
+                    cur_token = ""
+                    f_str_expr_opening_brackets = 0
+                    state = 4
+            elif str_is_f_string and c == "}" and line[i - 1 : i + 1] == "}}":
+                cur_token += "}"
+                i += 1
+            else:
+                cur_token += c
+        elif state == 3:  # identifier
+            if c in spaces + ops + "#":
+                yield "id", cur_token
+                cur_token = ""
+                state = 0
+                i -= 1
+            elif c in "\"'":  # identifier is string prefix
+                state = 1
+                str_prefix = cur_token
+                str_is_f_string = "f" in str_prefix or "F" in str_prefix
+                str_quote = c
+                cur_token = ""
+            else:
+                cur_token += c
+        elif state == 4:  # f-string expression (like state 0 but simplified)
+            if c in spaces:
+                pass
+            elif c in ops:
+                if f_str_expr_opening_brackets == 0 and c == "}":
+                    yield "f-str-expr-close", "}"
+                    state = 1  # back into the f-string
+                    cur_token = ""
+                else:
+                    yield "op", c
+                    if c in "([{":
+                        f_str_expr_opening_brackets += 1
+                    elif c in ")]}":
+                        if f_str_expr_opening_brackets > 0:
+                            f_str_expr_opening_brackets -= 1
+            else:
+                cur_token = c
+                state = 5  # identifier in f-string expression
+        elif state == 5:  # identifier in f-string expression (like state 3 but simplified)
+            if c in spaces + ops:
+                yield "id", cur_token
+                cur_token = ""
+                state = 4
+                i -= 1
+            else:
+                cur_token += c
+        elif state == 6:  # comment
+            cur_token += c
+    if state == 3:
+        yield "id", cur_token
+    elif state == 6:
+        yield "comment", cur_token
+
+
+def test_parse_py_statement_vs_reference():
+    import random
+
+    rnd = random.Random(42)
+    alphabet = list("af F bx1 ()[]{}.,:#'\"\\\n\t=") + ["{{", "}}", "f'", 'f"', "rb'"]
+    for _ in range(20000):
+        s = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 25)))
+        assert list(better_exchook.parse_py_statement(s)) == list(_parse_py_statement_reference(s)), s
+
+
 def test_parse_py_statement_f_string():
     assert list(better_exchook.parse_py_statement('f"hello"')) == [("f-str", "hello")]
     assert list(better_exchook.parse_py_statement('f"{{hello}}"')) == [("f-str", "{hello}")]
@@ -77,6 +204,25 @@ def test_is_source_code_missing_open_brackets():
     assert better_exchook.is_source_code_missing_open_brackets("a[0]: 'b'}).b()[0]") is True
 
 
+def test_get_source_code_identifier_prefixes():
+    import gc
+    import weakref
+
+    co = test_get_source_code_identifier_prefixes.__code__
+    func = better_exchook._get_source_code_identifier_prefixes
+    assert func(co, 1, "a.b(c, a.b.d)") == (("a",), ("a", "b"), ("c",), ("a", "b", "d"))
+    assert func(co, 1, "a.b(c, a.b.d)") is func(co, 1, "a.b(c, a.b.d)")  # cached
+    assert func(co, 1, "x = None") == (("x",),)  # source code changed
+
+    # The cache does not keep dynamically created code alive.
+    co = compile("x = None", "<dynamic>", "exec")
+    co_ref = weakref.ref(co)
+    assert func(co, 1, "x = None") == (("x",),)
+    del co
+    gc.collect()
+    assert co_ref() is None
+
+
 def test_add_indent_lines():
     """
     Test :func:`add_indent_lines`.
@@ -324,6 +470,27 @@ def test_exception_func_nicer_repr():
     assert lines[0].strip() == "f = <local> <function difflib.get_close_matches>"
 
 
+def test_exception_same_obj_ref():
+    exc_stdout = _run_code_format_exc(
+        textwrap.dedent("""\
+            def f(obj):
+                return g(obj, obj)
+            def g(obj, obj2):
+                return obj, obj2, obj[0] / 0
+            f(list(range(100)))
+            """),
+        ZeroDivisionError,
+    )
+    lines = [_remove_ansi_escape_codes(line) for line in exc_stdout.splitlines()]
+    assert [line for line in lines if line.startswith("  File ")][-2].endswith(", line 2, in f")
+    lines = [line.strip() for line in lines if " = <local> " in line][-3:]
+    assert lines[0].startswith("obj = <local> [0, 1, 2, ")
+    assert lines[1:] == [
+        "obj = <local> <same as obj in f, line 2>",
+        "obj2 = <local> <same as obj in f, line 2>",
+    ], lines
+
+
 def test_get_source_code_multi_line():
     dummy_fn = "<_test_multi_line_src>"
     source_code = "(lambda _x: None)("
@@ -337,6 +504,34 @@ def test_get_source_code_multi_line():
     assert src == source_code
 
 
+def test_get_source_code_multi_line_statement():
+    dummy_fn = "<_test_multi_line_statement>"
+    statement = "d = {\n    'a': 1,\n    'b': f(\n        2),\n}\n"
+    source_code = "x = 1\n" + statement + "# comment\ny = 2\n"
+    better_exchook.set_linecache(filename=dummy_fn, source=source_code)
+    for lineno in range(2, 7):
+        assert better_exchook.get_source_code(filename=dummy_fn, lineno=lineno) == statement
+    assert better_exchook.get_source_code(filename=dummy_fn, lineno=1) == "x = 1\n"
+    assert better_exchook.get_source_code(filename=dummy_fn, lineno=7) == "# comment\n"
+    assert better_exchook.get_source_code(filename=dummy_fn, lineno=8) == "y = 2\n"
+    assert better_exchook.get_source_code(filename=dummy_fn, lineno=9) == ""
+
+
+def test_get_source_code_big_literal():
+    items = ["    'item_%i': %i,\n" % (i, i) for i in range(600)]
+    items[300] = "    'bad': compute(),\n"
+    items[400] = "    'call': f(\n        1),\n"
+    source_code = "def compute():\n    raise ValueError('bad')\n\n\nCONFIG = {\n" + "".join(items) + "}\n"
+    exc_stdout = _run_code_format_exc(source_code, ValueError)
+    exc_stdout = _remove_ansi_escape_codes(exc_stdout)
+    assert "line: 'bad': compute()," in exc_stdout and "item_" not in exc_stdout
+    assert len(exc_stdout) < 2000
+    dummy_fn = "<_test_big_literal>"
+    better_exchook.set_linecache(filename=dummy_fn, source=source_code)
+    assert better_exchook.get_source_code(filename=dummy_fn, lineno=6 + 400) == "    'call': f(\n        1),\n"
+    assert better_exchook.get_source_code(filename=dummy_fn, lineno=5) == "CONFIG = {\n"
+
+
 def test_parse_py_statement_prefixed_str():
     # Our parser just ignores the prefix. But that is fine.
     code = "b'f(1,'"
@@ -377,6 +572,575 @@ def test_exception_chaining_implicit():
     assert "ValueError" in exc_stdout
 
 
+def test_format_exception():
+    try:
+        try:
+            {}["a"]
+        except KeyError as exc:
+            raise ValueError("failed") from exc
+    except ValueError:
+        lines = better_exchook.format_exception(*sys.exc_info(), with_color=False)
+    assert lines and all(line.endswith("\n") for line in lines)
+    out = "".join(lines)
+    assert out.index("KeyError") < out.index("direct cause of the following exception") < out.index("ValueError")
+    assert out.endswith("ValueError: failed\n")
+
+
+def test_frames_namespace():
+    a, b = 1, 2  # noqa: F841
+
+    def _inner():
+        a = 3  # noqa: F841
+        raise Exception("test")
+
+    try:
+        _inner()
+    except Exception:
+        tb = sys.exc_info()[2]
+    ns = better_exchook.FramesNamespace(tb, "f_locals")
+    assert ns["a"] == 3 and ns["b"] == 2 and "_inner" in ns and "c" not in ns
+    d = ns.materialize()
+    assert type(d) is dict and d["a"] == 3 and d["b"] == 2
+    ns = better_exchook.FramesNamespace(tb, "f_locals", limit=1)
+    assert ns["a"] == 1
+    ns_globals = better_exchook.FramesNamespace(tb, "f_globals")
+    assert ns_globals["better_exchook"] is better_exchook
+
+
+def test_exception_snapshot():
+    def _hook(etype, value, tb, file):
+        import pickle
+
+        snapshot = better_exchook.ExceptionSnapshot.from_exception(etype, value, tb, clear_frames=False)
+        snapshot = pickle.loads(pickle.dumps(snapshot))
+        file.write("".join(better_exchook.format_exception(None, snapshot, None, with_color=False)))
+        file.write("-" * 40 + "\n")
+        file.write("".join(better_exchook.format_exception(etype, value, tb, with_color=False)))
+
+    exc_stdout = _run_code_format_exc(
+        textwrap.dedent("""\
+            try:
+                x = {"a": [1, 2]}
+                x["b"]
+            except KeyError:
+                y = x["a"]
+                y[5]
+            """),
+        IndexError,
+        except_hook=_hook,
+    )
+    from_snapshot, direct = exc_stdout.split("-" * 40 + "\n")
+    assert from_snapshot == direct
+    assert "x = <local> {'a': [1, 2]}" in from_snapshot
+    assert "During handling of the above exception" in from_snapshot
+
+
+def test_exception_snapshot_clear_frames():
+    def _hook(etype, value, tb, file):
+        snapshot = better_exchook.ExceptionSnapshot.from_exception(etype, value, tb, clear_frames=True)
+        file.write("".join(better_exchook.format_exception(None, snapshot, None, with_color=False)))
+
+    # The chained exceptions share the module frame. It must only be cleared after everything was captured.
+    exc_stdout = _run_code_format_exc(
+        textwrap.dedent("""\
+            try:
+                x = {"a": [1, 2]}
+                x["b"]
+            except KeyError:
+                y = x["a"]
+                y[5]
+            """),
+        IndexError,
+        except_hook=_hook,
+    )
+    assert "x = <local> {'a': [1, 2]}" in exc_stdout
+    assert "y = <local> [1, 2]" in exc_stdout
+
+
+def test_exception_deferred():
+    def _hook(*args, **kwargs):
+        better_exchook.better_exchook(*args, deferred=True, with_color=False, **kwargs)
+        assert better_exchook.flush_deferred_reports(timeout=10.0)
+
+    exc_stdout = _run_code_format_exc("a = 42\nb = [a]\nb[a]", IndexError, except_hook=_hook)
+    assert "IndexError" in exc_stdout
+    assert "a = <local> 42" in exc_stdout
+
+
+def test_exception_deferred_render_failed():
+    def _render():
+        raise ValueError("render failed")
+
+    out = StringIO()
+    better_exchook._get_deferred_writer().submit(out, _render, "KeyError: 'x'\n")
+    assert better_exchook.flush_deferred_reports(timeout=10.0)
+    assert out.getvalue() == (
+        "better_exchook: rendering the exception report failed: ValueError: render failed\nKeyError: 'x'\n"
+    )
+
+
+def test_exception_json():
+    import json
+
+    def _hook(*args, **kwargs):
+        better_exchook.better_exchook(*args, as_json=True, **kwargs)
+
+    exc_stdout = _run_code_format_exc(
+        textwrap.dedent("""\
+            try:
+                x = {"a": 1}
+                x["b"]
+            except KeyError as exc:
+                y = "y" * 10000
+                raise ValueError(y) from exc
+            """),
+        ValueError,
+        except_hook=_hook,
+    )
+    assert exc_stdout.endswith("\n") and exc_stdout.count("\n") == 1
+    assert "\x1b" not in exc_stdout
+    d = json.loads(exc_stdout)
+    assert d["type"] == "ValueError"
+    assert [(e["type"], e["link"]) for e in d["chain"]] == [("KeyError", None), ("ValueError", "cause")]
+    frame = d["chain"][0]["frames"][-1]
+    assert frame["source"] == 'x["b"]'
+    assert frame["vars"] == [{"name": "x", "scope": "local", "repr": "{'a': 1}", "truncated": False}]
+    frame = d["chain"][1]["frames"][-1]
+    # The module frame is shared by both exceptions, so this checks that it was not cleared in between.
+    assert [(v["name"], v["scope"], v["truncated"]) for v in frame["vars"]] == [("y", "local", True)]
+
+
+def test_dump_all_thread_tracebacks_json():
+    import json
+
+    out = StringIO()
+    better_exchook.dump_all_thread_tracebacks(file=out, as_json=True)
+    threads = [json.loads(line) for line in out.getvalue().splitlines()]
+    (cur,) = [t for t in threads if "current" in t["tags"]]
+    assert cur["frames"][0]["name"] == "dump_all_thread_tracebacks"
+    assert any(f["name"] == "test_dump_all_thread_tracebacks_json" for f in cur["frames"])
+
+
+def test_exception_rate_limiter():
+    limiter = better_exchook.ExceptionRateLimiter(window=10.0, max_full_reports=2, max_summaries=1, digest_interval=5.0)
+    assert [limiter.check("a", now=float(t)) for t in range(4)] == [
+        ("full", 1),
+        ("full", 2),
+        ("summary", 3),
+        ("suppress", 4),
+    ]
+    assert limiter.check("b", now=3.0) == ("full", 1)
+    limiter.add_suppressed("a", "label a")
+    assert limiter.pop_digest(now=limiter._last_digest_time + 1.0) == []
+    digest = limiter.pop_digest(now=limiter._last_digest_time + 6.0)
+    assert len(digest) == 2 and digest[1] == "  1 x label a\n"
+    assert limiter.pop_digest(force=True) == []
+    assert limiter.check("a", now=20.0) == ("full", 1)  # new window
+
+
+def _raise_with_payload(payload):
+    raise ValueError(len(payload))
+
+
+def _raise_chained_with_payload():
+    """
+    Raises KeyError with a weakref to a local, which is also in a frame
+    which is only in the traceback of the chained exception.
+    """
+    import weakref
+
+    payload = _LazyDataset()
+    try:
+        _raise_with_payload(payload)
+    except ValueError:
+        payload_ref = weakref.ref(payload)
+        del payload
+        raise KeyError(payload_ref)
+
+
+def test_exception_rate_limit_digest_timer():
+    import gc
+
+    limiter = better_exchook.ExceptionRateLimiter(max_full_reports=0, max_summaries=0, digest_interval=0.05)
+    out = StringIO()
+    try:
+        _raise_chained_with_payload()
+    except KeyError as exc:
+        better_exchook.better_exchook(*sys.exc_info(), file=out, with_color=False, rate_limit=limiter)
+        gc.collect()
+        assert exc.args[0]() is None  # also the frames of the chained exception are cleared
+    assert out.getvalue() == ""  # suppressed
+    limiter._digest_timer.join(5.0)
+    assert "  1 x KeyError: " in out.getvalue()
+
+
+def test_exception_rate_limit():
+    limiter = better_exchook.ExceptionRateLimiter(max_full_reports=1, max_summaries=1)
+    out = StringIO()
+    for i in range(5):
+        try:
+            {}["key %i" % i]
+        except KeyError:
+            better_exchook.better_exchook(*sys.exc_info(), file=out, with_color=False, rate_limit=limiter)
+    out = out.getvalue()
+    assert out.count("EXCEPTION") == 1 and "KeyError: 'key 0'\n" in out
+    assert "better_exchook: KeyError: 'key 1' (at " in out and "[repeated 2 times " in out
+    assert "key 2" not in out
+    digest = "".join(limiter.pop_digest(force=True))
+    assert "  3 x KeyError: 'key 2' (at " in digest
+
+    fingerprints = set()
+    for i in range(2):
+        try:
+            [][i]
+        except IndexError:
+            fingerprints.add(better_exchook.get_exception_fingerprint(*sys.exc_info()))
+    assert len(fingerprints) == 1
+
+
+def _recursive_func(n):
+    if n <= 0:
+        raise ValueError("recursion end")
+    return _recursive_func(n - 1)
+
+
+class _UpdateCountingDict(dict):
+    num_updates = 0
+
+    def update(self, *args, **kwargs):
+        self.num_updates += 1
+        super().update(*args, **kwargs)
+
+
+def test_format_tb_recursion():
+    try:
+        _recursive_func(100)
+    except ValueError:
+        exc_info = sys.exc_info()
+    out = "".join(better_exchook.format_tb(exc_info[2], with_color=False, clear_frames=False))
+    assert out.count("  File ") == 4  # this func, first recursion, last recursion, the raise
+    assert "  [Previous line repeated 98 more times]\n" in out
+    assert "n = <local> 100\n" in out and "n = <local> 1\n" in out and "n = <local> 50\n" not in out
+    all_locals = _UpdateCountingDict()
+    better_exchook.format_tb(exc_info[2], with_color=False, clear_frames=False, allLocals=all_locals)
+    assert all_locals.num_updates == 102  # also the collapsed frames
+    snapshot = better_exchook.TracebackSnapshot.from_traceback(exc_info[2])
+    assert len(snapshot) == 102 and snapshot.frames[50].variables is None
+    assert "".join(better_exchook.format_tb(snapshot, with_color=False)) == out
+
+
+def test_format_tb_budget():
+    import traceback
+
+    stack = traceback.StackSummary.from_list([(__file__, 1 + i, "func_%i" % i, None) for i in range(100)])
+    better_exchook.cfg_max_frames = 10
+    try:
+        out = "".join(better_exchook.format_tb(stack, with_color=False))
+    finally:
+        better_exchook.cfg_max_frames = None
+    assert out.count("  File ") == 10 and "  [... 90 frames not shown ...]\n" in out
+    assert out.index("in func_4\n") < out.index("frames not shown") < out.index("in func_95\n")
+
+    a, b, c = 1, [2] * 1000, 3  # noqa: F841
+    try:
+        raise Exception(a, b, c)
+    except Exception:
+        tb = sys.exc_info()[2]
+    better_exchook.cfg_max_vars_per_frame = 2
+    try:
+        out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False))
+    finally:
+        better_exchook.cfg_max_vars_per_frame = None
+    assert "a = <local> 1\n" in out and "c = <local>" not in out and "[... more vars not shown ...]" in out
+
+    full_out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False))
+    assert "c = <local> 3\n" in full_out
+    budget = len(full_out) - 10
+    out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False, output_budget=budget))
+    assert "a = <local> 1\n" in out and "c = <local>" not in out and "[... more vars not shown ...]" in out
+    assert len(out) < budget + 40  # the budget is not strict, but we should not be too far off
+    # The header length depends on the path of this file, so measure it.
+    header = full_out.splitlines(True)[0]
+    assert header.startswith("  File ") and header.endswith(", in test_format_tb_budget\n")
+    out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False, output_budget=len(header) + 10))
+    assert out == header
+    all_locals = {}
+    out = "".join(
+        better_exchook.format_tb(tb, with_color=False, clear_frames=False, output_budget=0, allLocals=all_locals)
+    )
+    assert "  File " not in out and "output budget exceeded, 1 more frames not shown" in out
+    assert all_locals["c"] == 3  # also for the frames which are not shown
+
+
+class _CountingRepr:
+    def __init__(self):
+        self.num_reprs = 0
+
+    def __repr__(self):
+        self.num_reprs += 1
+        return "<_CountingRepr %s>" % ("x" * 100)
+
+
+def _max_vars_inner(x, y, cfg):
+    raise Exception(cfg)
+
+
+def _max_vars_outer(cfg):
+    x, y = 1, 2
+    _max_vars_inner(x, y, cfg)
+
+
+def test_format_tb_max_vars_not_rendered():
+    cfg = _CountingRepr()
+    try:
+        _max_vars_outer(cfg)
+    except Exception:
+        tb = sys.exc_info()[2]
+    better_exchook.cfg_max_vars_per_frame = 2
+    try:
+        # Skip our own frame. In the outer frame, cfg is the third var, so it is not shown there.
+        out = "".join(better_exchook.format_tb(tb.tb_next, with_color=False, clear_frames=False))
+    finally:
+        better_exchook.cfg_max_vars_per_frame = None
+    assert out.count("[... more vars not shown ...]") == 1
+    assert cfg.num_reprs == 1  # only rendered where it is shown
+    assert "cfg = <local> <_CountingRepr x" in out and "<same as" not in out
+    out = "".join(better_exchook.format_tb(tb.tb_next, with_color=False, clear_frames=False))
+    assert "cfg = <local> <_CountingRepr x" in out and "cfg = <local> <same as cfg in _max_vars_outer, line " in out
+
+
+class _SlowRepr:
+    def __repr__(self):
+        import time
+
+        time.sleep(0.05)
+        return "<_SlowRepr>"
+
+
+def test_format_tb_time_budget():
+    a, b, c = _SlowRepr(), 2, 3  # noqa: F841
+    try:
+        raise Exception(a, b, c)
+    except Exception:
+        tb = sys.exc_info()[2]
+    out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False, time_budget=0.02))
+    assert "a = <local> <_SlowRepr>\n" in out and "b = <local> <not rendered, time budget exceeded>\n" in out
+    out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False, time_budget=0.0))
+    assert "in test_format_tb_time_budget\n" in out and "line:" not in out
+
+    better_exchook.cfg_slow_repr_threshold = 0.01
+    try:
+        out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False))
+        assert "a = <local> <_SlowRepr>\n" in out
+        assert _SlowRepr in better_exchook.get_slow_repr_types()
+        out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False))
+        assert "a = <local> <%s._SlowRepr, not rendered, repr was slow before>\n" % __name__ in out
+        assert "b = <local> 2\n" in out
+
+        # Only the type with the slow repr is tracked, not the container.
+        better_exchook.reset_slow_repr_types()
+        assert better_exchook.bounded_repr({"a": _SlowRepr()}) == "{'a': <_SlowRepr>}"
+        assert set(better_exchook.get_slow_repr_types()) == {_SlowRepr}
+        assert better_exchook.bounded_repr({"b": 2}) == "{'b': 2}"
+        assert better_exchook.bounded_repr({"a": _SlowRepr()}) == (
+            "{'a': <%s._SlowRepr, not rendered, repr was slow before>}" % __name__
+        )
+    finally:
+        better_exchook.cfg_slow_repr_threshold = None
+        better_exchook.reset_slow_repr_types()
+
+
+class _LazyAttribs:
+    __slots__ = ("slot_value", "__dict__")
+
+    def __init__(self):
+        self.slot_value = 1
+        self.value = 2
+        self.loads = 0
+
+    @property
+    def lazy(self):
+        self.loads += 1
+        return self
+
+    def __getattr__(self, item):
+        self.loads += 1
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return 3
+
+
+def test_format_tb_static_attribute_lookup():
+    obj = _LazyAttribs()
+    obj.other = _LazyAttribs()
+    try:
+        raise Exception(obj.slot_value, obj.value, obj.lazy.value, obj.dynamic, obj.other.value)
+    except Exception:
+        tb = sys.exc_info()[2]
+    obj.loads = obj.other.loads = 0
+    better_exchook.cfg_static_attribute_lookup = True
+    try:
+        out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False))
+    finally:
+        better_exchook.cfg_static_attribute_lookup = False
+    assert obj.loads == 0 and obj.other.loads == 0
+    assert "obj.slot_value = <local> 1\n" in out and "obj.value = <local> 2\n" in out
+    assert "obj.lazy = <local> <property, not evaluated>\n" in out and "obj.lazy.value =" not in out
+    assert "obj.dynamic = <local> <__getattr__, not evaluated>\n" in out
+    assert "obj.__init__" not in out  # bound method
+
+    out = "".join(better_exchook.format_tb(tb, with_color=False, clear_frames=False))
+    assert obj.loads > 0 and "obj.lazy.value = <local> 2\n" in out and "obj.dynamic = <local> 3\n" in out
+
+
+class _LazyDataset:
+    def __init__(self):
+        self.loads = 0
+
+    def __len__(self):
+        self.loads += 1
+        return 1000
+
+    def __getitem__(self, item):
+        self.loads += 1
+        return [1, 2, 3]
+
+    def __repr__(self):
+        return "<_LazyDataset>"
+
+
+def test_summarize_obj():
+    import collections
+
+    assert better_exchook.summarize_obj([1, 2]) == ""
+    assert better_exchook.summarize_obj(list(range(10))) == "len = 10"
+    assert better_exchook.summarize_obj([list(range(10))]) == "_[0]: {len = 10}"
+    assert better_exchook.summarize_obj("x" * 8) == "len = 8"
+    # The len is always shown for these types, also when they are small.
+    for obj in [
+        b"x",
+        bytearray(b"x"),
+        range(1),
+        {1},
+        frozenset([1]),
+        collections.OrderedDict(a=1),
+        collections.defaultdict(list, a=[]),
+        collections.Counter("a"),
+    ]:
+        assert better_exchook.summarize_obj(obj) == "len = 1", obj
+    assert better_exchook.summarize_obj(collections.deque([list(range(10))])) == "len = 1, _[0]: {len = 10}"
+
+    class _MyList(list):
+        pass
+
+    dataset = _LazyDataset()
+    assert better_exchook.summarize_obj(dataset) == "" and dataset.loads == 0
+    assert better_exchook.summarize_obj(_MyList(range(10))) == ""  # subclasses could override __len__
+    better_exchook.register_obj_summarizer(_LazyDataset, lambda obj, depth_limit: "len = %i" % len(obj))
+    try:
+        assert better_exchook.summarize_obj(dataset) == "len = 1000" and dataset.loads == 1
+    finally:
+        better_exchook.register_obj_summarizer(_LazyDataset, None)
+    assert better_exchook.summarize_obj(dataset) == ""
+
+
+class _BigLocal:
+    def __init__(self):
+        self.data = bytearray(10**6)
+
+    def __repr__(self):
+        return "<_BigLocal>"
+
+
+def _fail_with_big_local(refs, kind):
+    """
+    :param list[weakref.ref] refs: weakrefs to the big locals are added here
+    :param str kind: "plain", "chain" or "syntax_error"
+    """
+    import weakref
+
+    big_local = _BigLocal()
+    refs.append(weakref.ref(big_local))
+    if kind == "plain":
+        raise ValueError("plain", len(big_local.data))
+    elif kind == "chain":
+        try:
+            _fail_with_big_local(refs, "plain")
+        except ValueError as exc:
+            raise RuntimeError("chained", len(big_local.data)) from exc
+    elif kind == "syntax_error":
+        compile("big_local = (", "<_fail_with_big_local>", "exec")
+    raise ValueError("unexpected kind %r" % kind)
+
+
+def test_exception_no_retention():
+    import gc
+    import io
+
+    for kind in ["plain", "chain", "syntax_error"]:
+        for hook_kwargs in [{}, {"deferred": True}, {"as_json": True}, {"rate_limit": True}, None]:
+            for zero_retention in [False, True]:
+                refs = []
+                try:
+                    _fail_with_big_local(refs, kind)
+                except Exception as exc:
+                    exc_ = exc
+                out = io.StringIO()
+                better_exchook.cfg_zero_retention = zero_retention
+                try:
+                    if hook_kwargs is None:
+                        better_exchook.print_exception(type(exc_), exc_, exc_.__traceback__, file=out)
+                    else:
+                        better_exchook.better_exchook(
+                            type(exc_), exc_, exc_.__traceback__, file=out, autodebugshell=False, **hook_kwargs
+                        )
+                finally:
+                    better_exchook.cfg_zero_retention = False
+                gc.collect()
+                assert refs and not [ref for ref in refs if ref() is not None], (kind, hook_kwargs, zero_retention)
+                if zero_retention:
+                    assert exc_.__traceback__ is None
+                    assert exc_.__context__ is None or exc_.__context__.__traceback__ is None
+                del exc_
+    better_exchook.flush_deferred_reports()
+
+
+def _extract_stack_with_big_local_frame(refs):
+    """
+    :param list[weakref.ref] refs: weakrefs to the big local is added here
+    :return: stack, where the top frame has a big local, and is kept alive by the stack
+    :rtype: traceback.StackSummary
+    """
+    import traceback
+    import weakref
+
+    big_local = _BigLocal()
+    refs.append(weakref.ref(big_local))
+    return better_exchook._StackSummary_extract(traceback.walk_stack(sys._getframe())) if big_local else None
+
+
+def test_stack_summary_no_retention():
+    import gc
+
+    for zero_retention in [False, True]:
+        refs = []
+        stack = _extract_stack_with_big_local_frame(refs)
+        gc.collect()
+        assert refs[0]() is not None  # kept alive by the frame
+        better_exchook.cfg_zero_retention = zero_retention
+        try:
+            out = _remove_ansi_escape_codes("".join(better_exchook.format_tb(stack)))
+        finally:
+            better_exchook.cfg_zero_retention = False
+        assert "big_local = <local> <_BigLocal>" in out
+        gc.collect()
+        assert refs[0]() is None
+        if zero_retention:
+            assert stack[0].tb_frame is None
+            out = _remove_ansi_escape_codes("".join(better_exchook.format_tb(stack)))
+            assert "in _extract_stack_with_big_local_frame" in out
+
+
 def test_pickle_extracted_stack():
     import pickle
     import traceback
@@ -397,8 +1161,56 @@ def test_pickle_extracted_stack():
         and len(stack2) == len(stack)
         and isinstance(stack2[0], traceback.FrameSummary)
     )
-    # We ignore the extended frame summary when serializing it.
-    assert type(stack2[0]) is traceback.FrameSummary
+    # The frame itself is not serialized, but a snapshot of it.
+    assert type(stack2[0]) is better_exchook.SnapshotFrameSummary
+    assert stack2[0].line.startswith("stack = _StackSummary_extract(")
+    stack2_str = _remove_ansi_escape_codes("".join(better_exchook.format_tb(stack2)))
+    assert "stack = <local> [" in stack2_str
+
+
+def test_stack_summary_extract_snapshot_limit():
+    import traceback
+
+    f = sys._getframe().f_back  # not the current frame, as its line changes
+    for limit in [None, 0, 1, 2, -1, -2, -1000]:
+        stack = better_exchook._StackSummary_extract_snapshot(traceback.walk_stack(f), limit=limit)
+        ref_stack = traceback.StackSummary.extract(traceback.walk_stack(f), limit=limit)
+        assert [(entry.filename, entry.lineno) for entry in stack] == [
+            (entry.filename, entry.lineno) for entry in ref_stack
+        ]
+
+
+def _extract_stack_with_big_local():
+    """
+    :return: extracted stack, and weakref to a big local of the top frame
+    :rtype: (traceback.StackSummary, weakref.ref)
+    """
+    import traceback
+    import weakref
+
+    big_local = _LazyDataset()
+    stack, _ = traceback.extract_stack(), big_local
+    return stack, weakref.ref(big_local)
+
+
+def test_replaced_traceback_format_tb_snapshot():
+    import gc
+    import traceback
+
+    orig_extract = vars(traceback.StackSummary)["extract"]
+    with better_exchook.replaced_traceback_format_tb():
+        stack, big_local_ref = _extract_stack_with_big_local()
+        assert all(type(entry) is better_exchook.SnapshotFrameSummary for entry in stack)
+        assert stack[-1].name.endswith("_extract_stack_with_big_local")
+        assert stack[-1].line.startswith("stack, _ = traceback.extract_stack()")
+        gc.collect()
+        assert big_local_ref() is None  # no frames are kept
+        stack_str = _remove_ansi_escape_codes("".join(traceback.format_list(stack)))
+        assert "stack, _ = traceback.extract_stack()" in stack_str and "big_local = <local> <_LazyDataset>" in stack_str
+    assert vars(traceback.StackSummary)["extract"] is orig_extract
+    assert traceback.format_tb is not better_exchook.format_tb
+    stack, big_local_ref = _extract_stack_with_big_local()
+    assert type(stack[-1]) is traceback.FrameSummary
 
 
 def test_extracted_stack_format_len():
@@ -416,6 +1228,213 @@ def test_extracted_stack_format_len():
     print("All ok.")
 
 
+def test_stack_summary_big():
+    import traceback
+
+    num_frames = 2000
+    stack = traceback.StackSummary.from_list(
+        [("<_test_stack_summary_big>", i + 1, "func_%i" % i, None) for i in range(num_frames)]
+    )
+    frames = list(better_exchook.iter_traceback(stack))
+    assert len(frames) == num_frames
+    assert [f.f_lineno for f in frames[:3]] == [1, 2, 3]
+    assert frames[-1].f_code.co_name == "func_%i" % (num_frames - 1)
+    stack_strs = better_exchook.format_tb(stack, with_color=False)
+    assert len(stack_strs) == num_frames
+    assert "line %i, in func_%i" % (num_frames, num_frames - 1) in stack_strs[-1]
+
+
+class _ClassForFuncFromCodeObject:
+    def method(self):
+        pass
+
+    @staticmethod
+    def static_method():
+        pass
+
+    @property
+    def prop(self):
+        return 42
+
+
+def test_get_func_from_code_object():
+    cls = _ClassForFuncFromCodeObject
+    for func in [test_get_func_from_code_object, cls.method, cls.static_method, cls.prop.fget]:
+        better_exchook._func_from_code_object_cache.clear()
+        assert better_exchook.get_func_from_code_object(func.__code__) is func
+        # Also check the fallback (e.g. for Python <3.11 without co_qualname).
+        mod = sys.modules[func.__module__]
+        assert better_exchook._get_func_from_code_object_index(func.__code__, mod) is func
+
+    def _closure():
+        pass
+
+    assert better_exchook.get_func_from_code_object(_closure.__code__) is None
+
+
+def test_func_from_code_object_index_replaced_func():
+    import gc
+    import types
+    import weakref
+
+    mod = types.ModuleType("_test_func_from_code_object_index")
+    exec("def f():\n    pass\n", mod.__dict__)
+    old_func = mod.f
+    assert better_exchook._get_func_from_code_object_index(old_func.__code__, mod) is old_func
+    # Replace the function, without changing the size of the module dict.
+    exec("def f():\n    pass\n", mod.__dict__)
+    assert better_exchook._get_func_from_code_object_index(mod.f.__code__, mod) is mod.f
+    # The index does not keep the old function alive.
+    old_func_ref = weakref.ref(old_func)
+    del old_func
+    gc.collect()
+    assert old_func_ref() is None
+
+
+def test_get_loaded_module_from_filename():
+    import types
+
+    assert better_exchook._get_loaded_module_from_filename(__file__) is sys.modules[__name__]
+    filename = "/nonexisting/_test_loaded_module_never_loaded.py"
+    assert better_exchook._get_loaded_module_from_filename(filename) is None
+    version = better_exchook._loaded_module_from_filename_index_version
+    assert better_exchook._loaded_module_from_filename_misses.get(filename) == version
+    filename = "/nonexisting/_test_loaded_module.py"
+    mod = types.ModuleType("_test_loaded_module")
+    mod.__file__ = filename
+    sys.modules[mod.__name__] = mod
+    try:
+        assert better_exchook._get_loaded_module_from_filename(filename) is mod
+    finally:
+        del sys.modules[mod.__name__]
+    # Some module removed and another one added, i.e. the same number of modules as before.
+    filename = "/nonexisting/_test_loaded_module_other.py"
+    other_mod = types.ModuleType("_test_loaded_module_other")
+    other_mod.__file__ = filename
+    sys.modules[mod.__name__] = mod
+    try:
+        assert better_exchook._get_loaded_module_from_filename(filename) is None
+        num_modules = len(sys.modules)
+        del sys.modules[mod.__name__]
+        sys.modules[other_mod.__name__] = other_mod
+        assert len(sys.modules) == num_modules
+        assert better_exchook._get_loaded_module_from_filename(filename) is other_mod
+    finally:
+        sys.modules.pop(mod.__name__, None)
+        sys.modules.pop(other_mod.__name__, None)
+
+
+def test_fallback_findfile():
+    import types
+
+    filename = "pkg/_test_fallback_findfile.py"
+    better_exchook._fallback_findfile_cache.clear()
+    assert better_exchook.fallback_findfile(filename) is None
+    version = better_exchook._loaded_module_from_filename_index_version
+    assert better_exchook._fallback_findfile_cache.get(filename) == (version, None)
+    mod = types.ModuleType("_test_fallback_findfile")
+    mod.__file__ = "/nonexisting/pkg/_test_fallback_findfile.pyc"
+    sys.modules[mod.__name__] = mod
+    try:
+        assert better_exchook.fallback_findfile(filename) == "/nonexisting/pkg/_test_fallback_findfile.py"
+        assert better_exchook.fallback_findfile("other/_test_fallback_findfile.py") is None
+    finally:
+        del sys.modules[mod.__name__]
+    # Found results are cached, even when the module is gone.
+    assert better_exchook.fallback_findfile(filename) == "/nonexisting/pkg/_test_fallback_findfile.py"
+
+
+def _format_tb_via_dynamic_class(i):
+    """
+    :param int i:
+    :return: formatted traceback, and weakrefs to the dynamically created class and to an object in the closure
+    :rtype: (str, list[weakref.ref])
+    """
+    import weakref
+
+    payload = _LazyDataset()
+
+    class _DynamicClass:
+        def fail(self):
+            raise ValueError(i, payload)
+
+    try:
+        _DynamicClass().fail()
+    except ValueError:
+        tb = sys.exc_info()[2]
+        frame = tb.tb_next.tb_frame
+        # On Python >=3.11, format_tb uses co_qualname, so explicitly resolve the function as well.
+        assert better_exchook.get_func_from_code_object(frame.f_code, frame=frame).__code__ is frame.f_code
+        del frame
+        out = "".join(better_exchook.format_tb(tb, with_color=False))
+        del tb
+    return out, [weakref.ref(_DynamicClass), weakref.ref(payload)]
+
+
+def test_func_from_code_object_cache_no_leak():
+    import gc
+
+    refs = []
+    for i in range(100):
+        out, refs_ = _format_tb_via_dynamic_class(i)
+        assert "_DynamicClass.fail" in out
+        refs.extend(refs_)
+    gc.collect()
+    assert not [ref for ref in refs if ref() is not None]
+    assert len(better_exchook._func_from_code_object_cache) <= better_exchook._func_from_code_object_cache.max_size
+
+
+def test_bounded_repr():
+    objs = [1, "a'b", b"x\n", bytearray(b"ab"), [], (), {}, set(), (1,), [1, (2, 3), {"a": {1, 2}}], frozenset([1])]
+    recursive_list = [1]
+    recursive_list.append(recursive_list)
+    objs.append(recursive_list)
+    recursive_tuple = ([],)
+    recursive_tuple[0].append(recursive_tuple)
+    recursive_dict = {"a": ([],)}
+    recursive_dict["a"][0].append(recursive_dict)
+    objs.extend([recursive_tuple, recursive_dict])
+    for obj in objs:
+        assert better_exchook.bounded_repr(obj) == repr(obj)
+    for obj in ["x" * 10000, list(range(100000)), {i: str(i) for i in range(10000)}, [b"\0" * 1000], set(range(1000))]:
+        s = better_exchook.bounded_repr(obj, limit=100)
+        assert 100 < len(s) < 200 and repr(obj).startswith(s)
+
+
+def test_py_syntax_highlight():
+    color = better_exchook.Color(enable=True)
+    for s in ["", "a", "if x:  # comment", "f(b'x\\'y', \"z\") + None", "'open\nx"]:
+        assert _remove_ansi_escape_codes(color.py_syntax_highlight(s)) == s
+    assert color.py_syntax_highlight("not a") == color("not", color.fg_colors[0]) + " a"
+    assert color.py_syntax_highlight("x#c") == "x" + color("#c", color.fg_colors[3])
+    assert color.py_syntax_highlight("b'x'") == "b" + color("'x'", color.fg_colors[2])
+    assert color.py_syntax_highlight_source("a()", filename="<x>", lineno=1) == color.py_syntax_highlight("a()")
+    # Cached, but still checked against the source.
+    assert color.py_syntax_highlight_source("b()", filename="<x>", lineno=1) == color.py_syntax_highlight("b()")
+
+
+def test_get_source_lines_revalidate():
+    old_interval = better_exchook.cfg_source_revalidate_interval
+    try:
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".py") as f:
+            f.write("a = 1\n")
+            f.flush()
+            better_exchook.cfg_source_revalidate_interval = None  # never re-stat
+            assert better_exchook.get_source_lines(f.name) == ["a = 1\n"]
+            assert better_exchook.source_file_exists(f.name)
+            f.write("b = 2\n")
+            f.flush()
+            assert better_exchook.get_source_lines(f.name) == ["a = 1\n"]
+            better_exchook.cfg_source_revalidate_interval = 0  # always re-stat
+            assert better_exchook.get_source_lines(f.name) == ["a = 1\n", "b = 2\n"]
+        assert not better_exchook.source_file_exists(f.name)
+        assert better_exchook.get_source_lines(f.name) == []
+        assert not better_exchook.source_file_exists("<string>")
+        assert better_exchook.get_source_lines("<string>") == []
+    finally:
+        better_exchook.cfg_source_revalidate_interval = old_interval
+
+
 def test():
     for k, v in sorted(globals().items()):
         if not k.startswith("test_"):